@@ -0,0 +1,138 @@
+from surprise import AlgoBase
+from surprise import SVD
+from surprise.utils import get_rng
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+import numpy as np
+import os
+
+class ALSAlgorithm(SVD):
+    """The SVD model (global mean + bu + bi + qi . pu) fitted by alternating least squares.
+
+    Every epoch solves the user biases and factors with the item ones fixed,
+    then the item ones with the user ones fixed. Each side is a batch of
+    small ridge regressions with the per-rating regularization of SGD
+    (``reg * n_ratings`` on every unknown), solved in blocks of rows by
+    NumPy / LAPACK on ``n_jobs`` threads. Parameters and fitted arrays are
+    the ones of ``SVD``, so the model is served, saved and folded in as one.
+    """
+
+    def __init__(self, n_factors=100, n_epochs=15, biased=True, init_mean=0, init_std_dev=.1, reg_all=.02,
+                 random_state=None, verbose=False, n_jobs=None, block_size=8192, cg_steps=3, progress=None):
+        SVD.__init__(self, n_factors=n_factors, n_epochs=n_epochs, biased=biased, init_mean=init_mean,
+                     init_std_dev=init_std_dev, reg_all=reg_all, random_state=random_state, verbose=verbose)
+        self.n_jobs = n_jobs
+        # Size of the solved batches, memory is about block_size x (n_factors + 1) floats per thread
+        self.block_size = block_size
+        # Conjugate gradient steps per solve after the first epoch, None for exact solves
+        self.cg_steps = cg_steps
+        self.progress = progress
+
+    def fit(self, trainset):
+        AlgoBase.fit(self, trainset)
+        self.als(trainset)
+        return self
+
+    def _solve_rows(self, ratings, other_biases, other_factors, reg_bias, reg_factors, previous, executor):
+        """Biases and factors of every row of ratings given the factors of the columns."""
+        global_mean = self.trainset.global_mean
+        if self.biased:
+            # The bias is one more unknown, with a column of ones
+            design = np.hstack([np.ones((len(other_factors), 1)), other_factors])
+            offsets = global_mean + other_biases
+            penalty = np.full(design.shape[1], reg_factors)
+            penalty[0] = reg_bias
+        else:
+            design = other_factors
+            offsets = np.zeros(len(other_factors))
+            penalty = np.full(design.shape[1], reg_factors)
+
+        # A zero row for the padding of shorter rows, it adds nothing to the sums
+        design = np.vstack([design, np.zeros(design.shape[1])])
+        offsets = np.append(offsets, 0)
+
+        n_rows = ratings.shape[0]
+        solution = np.empty((n_rows, design.shape[1]))
+        indptr = ratings.indptr
+        counts = np.diff(indptr)
+        # Rows are padded to the next power of two of their number of ratings and
+        # solved in batches of equal length, so every sum is one batched matmul
+        lengths = 2 ** np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64)
+        order = np.argsort(lengths, kind='stable')
+        batches = []
+        for length in np.unique(lengths).tolist():
+            rows = order[lengths[order] == length]
+            # Each batch holds block_size padded ratings or block_size / (n_factors + 1) gram matrices
+            step = max(1, self.block_size // max(length, design.shape[1]))
+            batches.extend((rows[start:start + step], length) for start in range(0, len(rows), step))
+
+        def solve(rows, length):
+            positions = np.minimum(indptr[rows][:, None] + np.arange(length), max(indptr[-1] - 1, 0))
+            padded = np.arange(length) < counts[rows][:, None]
+            columns = np.where(padded, ratings.indices[positions], len(design) - 1)
+            targets = np.where(padded, ratings.data[positions], 0) - offsets[columns]
+
+            rows_design = design[columns]
+            rows_design_t = rows_design.transpose(0, 2, 1)
+            gram = np.matmul(rows_design_t, rows_design)
+            moments = np.matmul(rows_design_t, targets[:, :, None])
+            diagonal = np.arange(design.shape[1])
+            gram[:, diagonal, diagonal] += counts[rows][:, None] * penalty
+            if self.cg_steps is None or previous is None:
+                solution[rows] = np.linalg.solve(gram, moments)[:, :, 0]
+                return
+            # A few conjugate gradient steps from the solution of the previous epoch
+            x = previous[rows][:, :, None]
+            residual = moments - np.matmul(gram, x)
+            direction = residual
+            residual_norm = np.sum(residual * residual, axis=1, keepdims=True)
+            for _ in range(self.cg_steps):
+                gram_direction = np.matmul(gram, direction)
+                curvature = np.sum(direction * gram_direction, axis=1, keepdims=True)
+                alpha = np.divide(residual_norm, curvature, out=np.zeros_like(curvature), where=curvature > 0)
+                x = x + alpha * direction
+                residual = residual - alpha * gram_direction
+                new_norm = np.sum(residual * residual, axis=1, keepdims=True)
+                beta = np.divide(new_norm, residual_norm, out=np.zeros_like(new_norm), where=residual_norm > 0)
+                direction = residual + beta * direction
+                residual_norm = new_norm
+            solution[rows] = x[:, :, 0]
+
+        list(executor.map(lambda batch: solve(*batch), batches))
+        return solution
+
+    def _split(self, solution):
+        """Biases and factors of solved rows."""
+        if self.biased:
+            return solution[:, 0], solution[:, 1:]
+        return np.zeros(len(solution)), solution
+
+    def als(self, trainset):
+        rng = get_rng(self.random_state)
+        users, items, values = [], [], []
+        for u, i, r in trainset.all_ratings():
+            users.append(u)
+            items.append(i)
+            values.append(r)
+        by_user = sparse.csr_matrix((values, (users, items)), shape=(trainset.n_users, trainset.n_items))
+        by_item = by_user.T.tocsr()
+
+        qi = rng.normal(self.init_mean, self.init_std_dev, size=(trainset.n_items, self.n_factors))
+        bi = np.zeros(trainset.n_items)
+        user_solution = item_solution = None
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs or os.cpu_count()) as executor:
+            for current_epoch in range(self.n_epochs):
+                if self.verbose:
+                    print("Processing epoch {}".format(current_epoch))
+                if self.progress is not None:
+                    self.progress(current_epoch, self.n_epochs)
+                user_solution = self._solve_rows(by_user, bi, qi, self.reg_bu, self.reg_pu, user_solution, executor)
+                item_solution = self._solve_rows(by_item, *self._split(user_solution), self.reg_bi, self.reg_qi,
+                                                 item_solution, executor)
+                bi, qi = self._split(item_solution)
+
+        if self.progress is not None:
+            self.progress(self.n_epochs, self.n_epochs)
+        self.bu, self.pu = self._split(user_solution)
+        self.bi, self.qi = bi, qi
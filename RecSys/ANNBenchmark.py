@@ -0,0 +1,81 @@
+from RecSys.ANNIndex import IVFIndex
+from RecSys.Ranking import top_n_indices
+import numpy as np
+import time
+
+# Set random seeds for reproducibility
+np.random.seed(0)
+
+n_items, n_queries, top_n = 50000, 200, 10
+
+# Synthetic item vectors with some cluster structure, like trained factors and tags
+def item_factors(n_factors=50, n_topics=100):
+    topics = np.random.normal(0, 1, (n_topics, n_factors))
+    factors = topics[np.random.randint(n_topics, size=n_items)] + np.random.normal(0, 0.7, (n_items, n_factors))
+    factors *= np.random.uniform(0.2, 0.6, (n_items, 1)) / np.sqrt(n_factors)
+    # Item biases as the last coordinate, user queries end with a 1
+    biases = np.random.normal(0, 0.3, (n_items, 1))
+    queries = np.hstack([np.random.normal(0, 0.5, (n_queries, n_factors)), np.ones((n_queries, 1))])
+    return np.hstack([factors, biases]), queries
+
+def tag_vectors(n_tags=300, n_topics=60):
+    # Products draw 1-6 tags, mostly from the tags of their topic
+    topic_tags = np.random.randint(n_tags, size=(n_topics, 12))
+    vectors = np.zeros((n_items, n_tags), dtype=np.float32)
+    for item, topic in enumerate(np.random.randint(n_topics, size=n_items).tolist()):
+        count = np.random.randint(1, 7)
+        own = topic_tags[topic, np.random.randint(12, size=count)]
+        vectors[item, np.where(np.random.random(count) < 0.8, own, np.random.randint(n_tags, size=count))] = 1
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query_items = np.random.randint(n_items, size=n_queries)
+    return vectors, vectors[query_items], query_items
+
+def benchmark(name, vectors, queries, exclude=None):
+    start = time.perf_counter()
+    index = IVFIndex.build(vectors)
+    build_seconds = time.perf_counter() - start
+    print(f"{name}: {n_items} items, {index.n_lists} lists, built in {build_seconds:.1f}s")
+
+    start = time.perf_counter()
+    thresholds = []
+    for q, query in enumerate(queries):
+        scores = vectors @ query
+        if exclude is not None:
+            scores[exclude[q]] = -np.inf
+        thresholds.append(scores[top_n_indices(scores, top_n)[-1]])
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"  exact      recall 1.000  {exact_ms:.2f} ms/query")
+
+    for n_probe in (1, 2, 4, 8, 16, 32, index.n_lists):
+        start = time.perf_counter()
+        found = [index.search(query, top_n, n_probe, None if exclude is None else exclude[q])
+                 for q, query in enumerate(queries)]
+        ms = (time.perf_counter() - start) / len(queries) * 1000
+        # Items tied with the n-th exact score count as found, tag similarities have many ties
+        recall = np.mean([np.sum(vectors[items] @ query >= threshold - 1e-9) / top_n
+                          for items, query, threshold in zip(found, queries, thresholds)])
+        print(f"  n_probe={n_probe:<4} recall {recall:.3f}  {ms:.2f} ms/query")
+
+factors, user_queries = item_factors()
+benchmark('SVD item factors', factors, user_queries)
+tags, tag_queries, query_items = tag_vectors()
+benchmark('Tag vectors', tags, tag_queries, exclude=query_items)
+
+# SVD item factors: 50000 items, 223 lists, built in 0.8s
+#   exact      recall 1.000  1.42 ms/query
+#   n_probe=1    recall 0.530  0.04 ms/query
+#   n_probe=2    recall 0.722  0.06 ms/query
+#   n_probe=4    recall 0.843  0.12 ms/query
+#   n_probe=8    recall 0.934  0.20 ms/query
+#   n_probe=16   recall 0.983  0.43 ms/query
+#   n_probe=32   recall 0.996  0.86 ms/query
+#   n_probe=223  recall 1.000  4.81 ms/query
+# Tag vectors: 50000 items, 223 lists, built in 2.7s
+#   exact      recall 1.000  3.85 ms/query
+#   n_probe=1    recall 0.871  0.20 ms/query
+#   n_probe=2    recall 0.953  0.37 ms/query
+#   n_probe=4    recall 0.981  0.41 ms/query
+#   n_probe=8    recall 0.994  0.67 ms/query
+#   n_probe=16   recall 0.997  1.24 ms/query
+#   n_probe=32   recall 1.000  2.40 ms/query
+#   n_probe=223  recall 1.000  28.85 ms/query
\ No newline at end of file
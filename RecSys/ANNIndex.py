@@ -0,0 +1,121 @@
+from RecSys.Ranking import top_n_indices
+import numpy as np
+
+# Arrays of an index saved with a model artifact, see attach_index
+INDEX_ARRAYS = ['ann_centroids', 'ann_indptr', 'ann_items', 'ann_vectors']
+
+class IVFIndex:
+    """Inverted file index for approximate maximum inner product search.
+
+    Items are split into ``n_lists`` clusters by spherical k-means and a
+    query only scores the items of the ``n_probe`` clusters whose centroids
+    match it best. ``n_probe`` is the recall / latency knob: with
+    ``n_probe = n_lists`` every item is scored and results are exact, see
+    ANNBenchmark for the curve.
+
+    Vectors of unequal norms (SVD item factors) are clustered after the
+    usual reduction of inner products to cosines: an extra coordinate
+    sqrt(M^2 - |x|^2) brings every vector to the largest norm M, and queries
+    get a 0 there, which leaves every inner product unchanged.
+    """
+
+    def __init__(self, centroids, indptr, items, vectors):
+        self.centroids = centroids      # n_lists x (dim + 1), unit rows
+        self.indptr = indptr            # items of list k are items[indptr[k]:indptr[k+1]], sorted
+        self.items = items
+        self.vectors = vectors          # n_items x dim, scored exactly
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_iter=10, sample_size=256, block_size=4096, seed=0):
+        """Cluster the rows of vectors, sqrt(n_items) lists by default.
+
+        k-means runs on at most ``sample_size`` items per list, then every
+        item goes to its closest centroid.
+        """
+        vectors = np.asarray(vectors)
+        n_items = len(vectors)
+        if n_items == 0:
+            return cls(np.zeros((0, vectors.shape[1] + 1), dtype=np.float32), np.zeros(1, dtype=np.int64),
+                       np.zeros(0, dtype=np.int64), vectors)
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_items))
+        n_lists = max(1, min(n_lists, n_items))
+
+        norms = np.linalg.norm(vectors, axis=1)
+        max_norm = norms.max()
+        extra = np.sqrt(np.maximum(max_norm ** 2 - norms ** 2, 0))
+        points = np.hstack([vectors, extra[:, None]]).astype(np.float32)
+        if max_norm > 0:
+            points /= max_norm
+
+        def assign(centroids):
+            labels = np.empty(n_items, dtype=np.int64)
+            for start in range(0, n_items, block_size):
+                labels[start:start + block_size] = np.argmax(points[start:start + block_size] @ centroids.T, axis=1)
+            return labels
+
+        rng = np.random.default_rng(seed)
+        sample = points[rng.choice(n_items, min(n_items, n_lists * sample_size), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            lengths = np.linalg.norm(sums, axis=1)
+            # Empty clusters restart from a random sample item
+            empty = lengths == 0
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            centroids = sums / np.where(empty, 1, lengths)[:, None]
+
+        labels = assign(centroids)
+        items = np.argsort(labels, kind='stable')
+        indptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=indptr[1:])
+        return cls(centroids, indptr, items, vectors)
+
+    def candidates(self, query, n_probe):
+        """Items of the n_probe lists closest to the query, in item order."""
+        list_scores = self.centroids[:, :-1] @ np.asarray(query, dtype=self.centroids.dtype)
+        probed = top_n_indices(list_scores, n_probe)
+        lists = [self.items[self.indptr[k]:self.indptr[k + 1]] for k in probed.tolist()]
+        return np.sort(np.concatenate([self.items[:0]] + lists))
+
+    def search(self, query, n, n_probe, exclude=None):
+        """Approximate top n items by inner product with the query, best first.
+
+        Ties are broken by item order, as in an exact ``top_n_indices`` over
+        every item.
+        """
+        items = self.candidates(query, n_probe)
+        if exclude is not None:
+            items = items[~np.isin(items, exclude)]
+        scores = self.vectors[items] @ query
+        return items[top_n_indices(scores, n)]
+
+def attach_index(algorithm, index):
+    """Store the index on the algorithm so that it is saved with its artifact."""
+    for name, value in zip(INDEX_ARRAYS, (index.centroids, index.indptr, index.items, index.vectors)):
+        setattr(algorithm, name, value)
+
+def model_index(algorithm):
+    """Index saved with the algorithm, None if it has none."""
+    arrays = [getattr(algorithm, name, None) for name in INDEX_ARRAYS]
+    if any(array is None for array in arrays):
+        return None
+    return IVFIndex(*arrays)
+
+def svd_item_vectors(algorithm):
+    """Item vectors of an SVD model, their inner product with svd_query ranks items as the estimate does."""
+    if algorithm.biased:
+        return np.hstack([algorithm.qi, np.asarray(algorithm.bi)[:, None]])
+    return np.asarray(algorithm.qi)
+
+def svd_query(algorithm, pu):
+    """Query vector of a user with factors pu, pu None (a user the model knows nothing about) queries zero factors."""
+    if pu is None:
+        pu = np.zeros(algorithm.qi.shape[1])
+    return np.append(pu, 1) if algorithm.biased else np.asarray(pu)
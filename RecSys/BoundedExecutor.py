@@ -0,0 +1,63 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+
+class ExecutorBusy(Exception):
+    """Raised when too many calls are already waiting for a worker."""
+
+class BoundedExecutor:
+    """Run blocking calls off the event loop on a bounded thread pool.
+
+    At most ``max_workers`` calls run at once and at most ``max_pending`` are
+    accepted in total (running + queued); beyond that ``run`` raises
+    ``ExecutorBusy`` right away so callers can shed load instead of piling up
+    requests, or with ``wait`` set waits for an accepted call to finish. NumPy releases the GIL in its heavy kernels, so scoring threads
+    use several cores.
+    """
+
+    def __init__(self, max_workers, max_pending, name):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        # Only touched from the event loop thread
+        self._pending = 0
+        # Futures of the callers waiting for a slot, first come first served
+        self._waiters = deque()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _wake_next(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def run(self, fn, *args, wait=False, **kwargs):
+        loop = asyncio.get_running_loop()
+        while self._pending >= self.max_pending:
+            if not wait:
+                raise ExecutorBusy(f'{self.name} executor is busy, retry later')
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass on a slot given to a caller that went away
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_next()
+                raise
+
+        self._pending += 1
+        try:
+            return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+            self._wake_next()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
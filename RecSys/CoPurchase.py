@@ -0,0 +1,163 @@
+from RecSys.Ranking import top_n_indices
+from scipy import sparse
+import numpy as np
+import pandas as pd
+import os
+
+COMPLETED_STATUS = 10
+
+class CoPurchaseIndex:
+    """In-memory frequently-bought-together index built from order baskets.
+
+    Answers the same questions as ``queries.cross_sell_rec_all_customer`` and
+    ``queries.cross_sell_rec`` without touching the database:
+
+    - ``pair_counts``: product x product count of order-item pairs over every
+      order (the all-customer query),
+    - ``completed_pair_counts``: the same over completed orders of known
+      customers (the per-customer query),
+    - per-customer counts of the category pairs found in their own completed
+      orders, from which the Contribution of a category pair is derived.
+    """
+
+    def __init__(self, product_ids, product_category, pair_counts, completed_pair_counts,
+                 customer_ids, customer_indptr, customer_cat_1, customer_cat_2, customer_pair_counts):
+        self.product_ids = product_ids              # sorted, int64
+        self.product_category = product_category    # parent category, -1 if unknown
+        self.pair_counts = pair_counts              # csr, aligned with product_ids
+        self.completed_pair_counts = completed_pair_counts
+
+        # CSR by customer: category pairs of customer_ids[k] are at indptr[k]:indptr[k+1]
+        self.customer_ids = customer_ids
+        self.customer_indptr = customer_indptr
+        self.customer_cat_1 = customer_cat_1
+        self.customer_cat_2 = customer_cat_2
+        self.customer_pair_counts = customer_pair_counts
+
+    @staticmethod
+    def _pair_matrix(baskets, product_ids):
+        orders = pd.factorize(baskets['OrdersId'])[0]
+        columns = np.searchsorted(product_ids, baskets['ProductId'].to_numpy(dtype=np.int64))
+        items = sparse.csr_matrix((np.ones(len(baskets)), (orders, columns)),
+                                  shape=(orders.max() + 1 if len(orders) else 0, len(product_ids)))
+        # Every pair of order items with different products, counted like the SQL self-join
+        pairs = (items.T @ items).tocsr()
+        pairs.setdiag(0)
+        pairs.eliminate_zeros()
+        return pairs
+
+    @classmethod
+    def from_baskets(cls, baskets):
+        """Build the index from OrdersId, CustomerId, StatusId, ProductId, CategoryId rows."""
+        baskets = baskets.dropna(subset=['OrdersId', 'ProductId'])
+        product_ids = np.unique(baskets['ProductId'].to_numpy(dtype=np.int64))
+        pair_counts = cls._pair_matrix(baskets, product_ids)
+
+        completed = baskets[(baskets['StatusId'] == COMPLETED_STATUS)
+                            & baskets['CustomerId'].notna() & baskets['CategoryId'].notna()]
+        completed_pair_counts = cls._pair_matrix(completed, product_ids)
+
+        product_category = np.full(len(product_ids), -1, dtype=np.int64)
+        categories = completed.drop_duplicates('ProductId')
+        product_category[np.searchsorted(product_ids, categories['ProductId'].to_numpy(dtype=np.int64))] = \
+            categories['CategoryId'].to_numpy(dtype=np.int64)
+
+        # Distinct product pairs per customer order, counted by category pair
+        items = completed[['CustomerId', 'OrdersId', 'ProductId', 'CategoryId']].drop_duplicates(
+            ['CustomerId', 'OrdersId', 'ProductId'])
+        pairs = items.merge(items, on=['CustomerId', 'OrdersId'])
+        pairs = pairs[pairs['ProductId_x'] < pairs['ProductId_y']]
+        pairs = pd.DataFrame({
+            'CustomerId': pairs['CustomerId'].to_numpy(dtype=np.int64),
+            'cat_1': np.minimum(pairs['CategoryId_x'], pairs['CategoryId_y']).to_numpy(dtype=np.int64),
+            'cat_2': np.maximum(pairs['CategoryId_x'], pairs['CategoryId_y']).to_numpy(dtype=np.int64),
+        })
+        cat_pairs = pairs.groupby(['CustomerId', 'cat_1', 'cat_2']).size().reset_index(name='PairCount')
+
+        customer_ids, counts = np.unique(cat_pairs['CustomerId'].to_numpy(), return_counts=True)
+        customer_indptr = np.zeros(len(customer_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=customer_indptr[1:])
+
+        return cls(product_ids, product_category, pair_counts, completed_pair_counts,
+                   customer_ids, customer_indptr, cat_pairs['cat_1'].to_numpy(), cat_pairs['cat_2'].to_numpy(),
+                   cat_pairs['PairCount'].to_numpy(dtype=np.int64))
+
+    def save(self, path):
+        arrays = {
+            'product_ids': self.product_ids,
+            'product_category': self.product_category,
+            'customer_ids': self.customer_ids,
+            'customer_indptr': self.customer_indptr,
+            'customer_cat_1': self.customer_cat_1,
+            'customer_cat_2': self.customer_cat_2,
+            'customer_pair_counts': self.customer_pair_counts,
+        }
+        for name in ('pair_counts', 'completed_pair_counts'):
+            matrix = getattr(self, name)
+            arrays[name + '_data'] = matrix.data
+            arrays[name + '_indices'] = matrix.indices
+            arrays[name + '_indptr'] = matrix.indptr
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            np.savez(index_file, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            arrays = {key: arrays[key] for key in arrays.files}
+        shape = (len(arrays['product_ids']), len(arrays['product_ids']))
+        matrices = [sparse.csr_matrix((arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr']),
+                                      shape=shape)
+                    for name in ('pair_counts', 'completed_pair_counts')]
+        return cls(arrays['product_ids'], arrays['product_category'], *matrices,
+                   arrays['customer_ids'], arrays['customer_indptr'], arrays['customer_cat_1'],
+                   arrays['customer_cat_2'], arrays['customer_pair_counts'])
+
+    def _contributions(self, customer_id):
+        """Share of each category pair among the customer's own product pairs."""
+        k = np.searchsorted(self.customer_ids, customer_id)
+        if k == len(self.customer_ids) or self.customer_ids[k] != customer_id:
+            return {}
+        start, end = self.customer_indptr[k], self.customer_indptr[k + 1]
+        counts = self.customer_pair_counts[start:end]
+        total = counts.sum()
+        return {(cat_1, cat_2): count / total for cat_1, cat_2, count in
+                zip(self.customer_cat_1[start:end].tolist(), self.customer_cat_2[start:end].tolist(), counts.tolist())}
+
+    def cross_sell(self, product_id, catalog, customer_id=None, n=10):
+        """Products most often bought together with product_id, only active ones.
+
+        Without a customer, ranked by PairCount over every order. With a
+        customer, the top n by PairCount over completed orders are re-ranked
+        by the Contribution of their category pair to the customer's baskets,
+        then by PairCount.
+        """
+        row = np.searchsorted(self.product_ids, product_id)
+        if row == len(self.product_ids) or self.product_ids[row] != product_id:
+            return []
+
+        pair_counts = self.completed_pair_counts if customer_id else self.pair_counts
+        start, end = pair_counts.indptr[row], pair_counts.indptr[row + 1]
+        others = pair_counts.indices[start:end]
+        counts = pair_counts.data[start:end]
+
+        # Only active products, as the SQL joins on Product.Active = 1
+        catalog_rows = catalog.rows_of(self.product_ids[others])
+        active = catalog_rows >= 0
+        active[active] = catalog.active[catalog_rows[active]]
+        others, counts = others[active], counts[active]
+
+        top = top_n_indices(counts, n)
+        others, counts = others[top], counts[top]
+        if not customer_id:
+            return self.product_ids[others].tolist()
+
+        contributions = self._contributions(customer_id)
+        category = self.product_category[row]
+        pair_contribution = np.array([
+            contributions.get((min(category, other), max(category, other)), -np.inf)
+            for other in self.product_category[others].tolist()])
+        order = np.lexsort((np.arange(len(others)), -counts, -pair_contribution))
+        return self.product_ids[others[order]].tolist()
@@ -1,9 +1,12 @@
-from ProductPreference import ProductInfo
+from RecSys.ProductPreference import ProductInfo
+from RecSys.ALSAlgorithm import ALSAlgorithm
 from surprise import SVD, accuracy
 from surprise.model_selection import train_test_split
 import numpy as np
 import random
 
+# Run from the repository root: python -m RecSys.CollabModelsEvaluation
+
 # Set random seeds for reproducibility
 np.random.seed(0)
 random.seed(0)
@@ -29,4 +32,12 @@ rmse = accuracy.rmse(predictions)
 mae = accuracy.mae(predictions)
 
 # RMSE: 0.3076
-# MAE:  0.1768
\ No newline at end of file
+# MAE:  0.1768
+
+# Same model and split, fitted by alternating least squares as TDS_RecSysTraining does with 'als'
+ALSModel = ALSAlgorithm(n_factors=50, n_epochs=10, reg_all= 0.05, random_state=42)
+ALSModel.fit(trainset)
+als_predictions = ALSModel.test(testset)
+
+als_rmse = accuracy.rmse(als_predictions)
+als_mae = accuracy.mae(als_predictions)
@@ -1,10 +1,12 @@
-from ProductPreference import ProductInfo
+from RecSys.ProductPreference import ProductInfo
 from surprise import accuracy
 from surprise.model_selection import train_test_split
-from ContentKNNAlgorithm import ContentKNNAlgorithm
+from RecSys.ContentKNNAlgorithm import ContentKNNAlgorithm
 import numpy as np
 import random
 
+# Run from the repository root: python -m RecSys.ContentBasedEvaluation
+
 # Set random seeds for reproducibility
 np.random.seed(0)
 random.seed(0)
@@ -1,43 +1,132 @@
 from surprise import AlgoBase
 from surprise import PredictionImpossible
 from RecSys.ProductPreference import ProductInfo
+from RecSys.Ranking import top_n_indices, top_n_rows
+from RecSys.ANNIndex import IVFIndex, attach_index, model_index
+from scipy import sparse
 import math
 import numpy as np
 import heapq
 
+def tag_similarity_blocks(tag_matrix, block_size=500):
+    """Yield (start, end, block) with the cosine similarities of rows start:end
+    against every row of the sparse binary item x tag matrix.
+
+    Same arithmetic as ``computeTagSimilarity`` (sumxy / sqrt(sumxx * sumyy)),
+    so results are identical. Items without tags get 0, as does the diagonal.
+    """
+    tag_matrix = sparse.csr_matrix(tag_matrix, dtype=np.float64)
+    tag_counts = np.asarray(tag_matrix.multiply(tag_matrix).sum(axis=1)).ravel()
+    tag_matrix_t = tag_matrix.T.tocsc()
+    n_items = tag_matrix.shape[0]
+
+    for start in range(0, n_items, block_size):
+        end = min(start + block_size, n_items)
+        block = (tag_matrix[start:end] @ tag_matrix_t).toarray()
+        norms = np.sqrt(np.outer(tag_counts[start:end], tag_counts))
+        np.divide(block, norms, out=block, where=norms > 0)
+        block[norms == 0] = 0
+        block[np.arange(end - start), np.arange(start, end)] = 0
+        yield start, end, block
+
+def fit_content_models(models, tag_matrix=None, block_size=500, progress=None, ann_index=False):
+    """Fit several (ContentKNNAlgorithm, trainset) pairs from one similarity computation.
+
+    Cosine similarities are computed once over the union of the items of
+    every trainset and each model takes the rows and columns of its own
+    items, so models sharing most of their items cost little more than one.
+    With ``ann_index`` set, every model also gets an approximate index of
+    its dense unit tag vectors, for ``get_similar_items`` with ``n_probe``.
+    """
+    # Load up tag vectors for every product as a sparse product x tag matrix
+    productRows, tagMatrix = tag_matrix if tag_matrix is not None else ProductInfo().getTagMatrix()
+
+    # Union rows of the inner items of every model
+    union = {}
+    model_rows = []
+    for algo, trainset in models:
+        AlgoBase.fit(algo, trainset)
+        algo._allocate()
+        model_rows.append(np.array([union.setdefault(int(trainset.to_raw_iid(i)), len(union))
+                                    for i in range(trainset.n_items)], dtype=np.int64))
+    model_inner = []
+    for rows in model_rows:
+        inner = np.full(len(union), -1, dtype=np.int64)
+        inner[rows] = np.arange(len(rows))
+        model_inner.append(inner)
+
+    # Products without tags get an empty row
+    rows = np.array([productRows.get(productID, -1) for productID in union], dtype=np.int64)
+    itemTags = tagMatrix[np.maximum(rows, 0)].multiply((rows >= 0)[:, None]).tocsr()
+
+    print("Computing content-based similarity matrix...")
+
+    # Compute cosine similarity for every product combination, one block of rows at a time
+    for start, end, block in tag_similarity_blocks(itemTags, block_size):
+        print(start, " of ", len(union))
+        if progress is not None:
+            progress(start, len(union))
+        for (algo, _), rows, inner in zip(models, model_rows, model_inner):
+            block_inner = inner[start:end]
+            in_model = block_inner >= 0
+            if in_model.any():
+                algo._store_block(block_inner[in_model], block[in_model][:, rows])
+
+    if progress is not None:
+        progress(len(union), len(union))
+    print("...done.")
+
+    if not ann_index:
+        return
+
+    # Unit tag vectors of every model's items, indexed for approximate get_similar_items
+    norms = np.sqrt(np.asarray(itemTags.multiply(itemTags).sum(axis=1)).ravel())
+    vectors = sparse.csr_matrix(itemTags.multiply(1 / np.where(norms > 0, norms, 1)[:, None]), dtype=np.float32)
+    for (algo, _), rows in zip(models, model_rows):
+        attach_index(algo, IVFIndex.build(vectors[rows].toarray()))
+
 class ContentKNNAlgorithm(AlgoBase):
 
-    def __init__(self, k=40, sim_options={}):
+    def __init__(self, k=40, sim_options={}, block_size=500, n_neighbors=None, progress=None):
+        """With ``n_neighbors`` set, only the n_neighbors most similar items of
+        every item are kept (float32 scores, int32 ids) instead of the dense
+        n_items x n_items float64 matrix. Similarities to items outside that
+        list are treated as 0.
+
+        ``progress`` is an optional callable receiving (done, total) items
+        after every block of the similarity matrix."""
         AlgoBase.__init__(self)
         self.k = k
+        self.block_size = block_size
+        self.n_neighbors = n_neighbors
+        self.progress = progress
 
-    def fit(self, trainset):
-        AlgoBase.fit(self, trainset)
+    def fit(self, trainset, tag_matrix=None):
+        """``tag_matrix`` is an optional ``ProductInfo.getTagMatrix()`` result,
+        to parse the product file once for several models."""
+        fit_content_models([(self, trainset)], tag_matrix, self.block_size, self.progress)
+        return self
 
-        # Compute item similarity matrix based on content attributes
+    def _allocate(self):
+        if self.n_neighbors is None:
+            self.similarities = np.zeros((self.trainset.n_items, self.trainset.n_items))
+        else:
+            self.similarities = None
+            n_neighbors = min(self.n_neighbors, max(self.trainset.n_items - 1, 0))
+            self.neighbor_ids = np.full((self.trainset.n_items, n_neighbors), -1, dtype=np.int32)
+            self.neighbor_sims = np.zeros((self.trainset.n_items, n_neighbors), dtype=np.float32)
 
-        # Load up genre vectors for every product
-        ml = ProductInfo()
-        tags = ml.getTags()
-        
-        print("Computing content-based similarity matrix...")
-            
-        # Compute genre distance for every product combination as a 2x2 matrix
-        self.similarities = np.zeros((self.trainset.n_items, self.trainset.n_items))
-        
-        for thisRating in range(self.trainset.n_items):
-            if (thisRating % 100 == 0):
-                print(thisRating, " of ", self.trainset.n_items)
-            for otherRating in range(thisRating+1, self.trainset.n_items):
-                thisProductID = int(self.trainset.to_raw_iid(thisRating))
-                otherProductID = int(self.trainset.to_raw_iid(otherRating))
-                genreSimilarity = self.computeTagSimilarity(thisProductID, otherProductID, tags)
-                self.similarities[thisRating, otherRating] = genreSimilarity
-                self.similarities[otherRating, thisRating] = self.similarities[thisRating, otherRating]
-                
-        print("...done.")
-                
-        return self
+    def _store_block(self, inner_ids, block):
+        """Store the similarity rows of inner_ids, block columns are in inner id order."""
+        if self.similarities is not None:
+            self.similarities[inner_ids] = block
+            return
+
+        # Keep the top neighbors of every row, most similar first, never the item itself
+        block[np.arange(len(inner_ids)), inner_ids] = -np.inf
+        top = top_n_rows(block, self.neighbor_ids.shape[1])
+        self.neighbor_ids[inner_ids] = top
+        self.neighbor_sims[inner_ids] = np.take_along_axis(block, top, axis=1)
     
     def computeTagSimilarity(self, product1, product2, tags):
         tags1 = tags[product1]
@@ -53,16 +142,94 @@ class ContentKNNAlgorithm(AlgoBase):
         
         return sumxy/math.sqrt(sumxx*sumyy)
 
+    def similarity(self, i, items):
+        """Similarities between inner item i and an array of inner item ids."""
+        if self.similarities is not None:
+            return self.similarities[i, items]
+        match = self.neighbor_ids[i][None, :] == np.asarray(items)[:, None]
+        return (match * self.neighbor_sims[i]).sum(axis=1, dtype=np.float64)
+
+    def similarity_matrix(self, items, others):
+        """Similarities between two arrays of inner item ids, as an (items x others) array."""
+        if self.similarities is not None:
+            return self.similarities[np.ix_(items, others)]
+
+        # Scatter the neighbor lists of items into the columns of others
+        column = np.full(self.trainset.n_items, -1, dtype=np.int64)
+        column[others] = np.arange(len(others))
+        neighbor_ids = self.neighbor_ids[items]
+        columns = np.where(neighbor_ids >= 0, column[neighbor_ids], -1)
+        rows, positions = np.nonzero(columns >= 0)
+        matrix = np.zeros((len(items), len(others)))
+        matrix[rows, columns[rows, positions]] = self.neighbor_sims[items][rows, positions]
+        return matrix
+
+    def estimate_batch(self, u, items, block_size=2048):
+        """Estimate the ratings of inner user u for an array of inner item ids at once.
+
+        Gives the same values as ``estimate``; items that cannot be predicted
+        (unknown user or item, no positive neighbor) are NaN.
+        """
+        items = np.asarray(items, dtype=np.int64)
+        estimates = np.full(len(items), np.nan)
+        if not self.trainset.knows_user(u):
+            return estimates
+
+        userRatings = self.trainset.ur[u]
+        rated = np.array([rating[0] for rating in userRatings], dtype=np.int64)
+        ratings = np.array([rating[1] for rating in userRatings], dtype=np.float64)
+        return self.estimate_from_ratings(rated, ratings, items, block_size)
+
+    def estimate_from_ratings(self, rated, ratings, items, block_size=2048, normalize=True):
+        """``estimate_batch`` for a user given by the inner ids and ratings of the items they rated.
+
+        Scores visitors the model was not trained on, or more recent ratings
+        than the trainset holds. With ``normalize`` False the similarity
+        weighted sum of the neighbor ratings is returned instead of their
+        weighted average, which still ranks items when all ratings are equal.
+        """
+        items = np.asarray(items, dtype=np.int64)
+        estimates = np.full(len(items), np.nan)
+        rated = np.asarray(rated, dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        known = np.flatnonzero((items >= 0) & (items < self.trainset.n_items))
+
+        for start in range(0, len(known), block_size):
+            positions = known[start:start + block_size]
+            sims = self.similarity_matrix(items[positions], rated)
+
+            # Extract the top-K most-similar ratings, most similar first and ties in the
+            # user's rating order like heapq.nlargest, even with k ratings or less: the
+            # order of the sums below changes their last bits
+            top = np.argsort(-sims, axis=1, kind='stable')[:, :self.k]
+            sims = np.take_along_axis(sims, top, axis=1)
+            neighborRatings = ratings[top]
+
+            # Accumulate neighbor by neighbor, in the same order as estimate
+            simTotal = np.zeros(len(positions))
+            weightedSum = np.zeros(len(positions))
+            for n in range(sims.shape[1]):
+                positive = sims[:, n] > 0
+                simTotal += np.where(positive, sims[:, n], 0)
+                weightedSum += np.where(positive, sims[:, n] * neighborRatings[:, n], 0)
+
+            if not normalize:
+                estimates[positions] = np.where(simTotal > 0, weightedSum, np.nan)
+                continue
+            with np.errstate(invalid='ignore', divide='ignore'):
+                estimates[positions] = np.where(simTotal > 0, weightedSum / simTotal, np.nan)
+
+        return estimates
+
     def estimate(self, u, i):
 
         if not (self.trainset.knows_user(u) and self.trainset.knows_item(i)):
             raise PredictionImpossible('User and/or item is unkown.')
         
         # Build up similarity scores between this item and everything the user rated
-        neighbors = []
-        for rating in self.trainset.ur[u]:
-            genreSimilarity = self.similarities[i,rating[0]]
-            neighbors.append( (genreSimilarity, rating[1]) )
+        userRatings = self.trainset.ur[u]
+        similarities = self.similarity(i, [rating[0] for rating in userRatings])
+        neighbors = list(zip(similarities.tolist(), [rating[1] for rating in userRatings]))
         
         # Extract the top-K most-similar ratings
         k_neighbors = heapq.nlargest(self.k, neighbors, key=lambda t: t[0])
@@ -81,20 +248,59 @@ class ContentKNNAlgorithm(AlgoBase):
 
         return predictedRating
     
-    def get_similar_items(self, i, top_n=10):
-        """Get top-N most similar items to the given itemID based on content similarity."""
+    def get_similar_items(self, i, top_n=10, n_probe=None):
+        """Get top-N most similar items to the given itemID based on content similarity.
+
+        With ``n_probe`` set, items are found by the approximate index of the
+        tag vectors, searching n_probe of its lists (see ANNIndex).
+        """
         
         # Convert the raw itemID to the internal item index
         inner_id = self.trainset.to_inner_iid(str(i))
 
-        # Get similarity scores for the item with all other items
-        similarity_scores = list(enumerate(self.similarities[inner_id]))
+        index = model_index(self) if n_probe is not None else None
+        if index is not None:
+            top_n_similar = index.search(index.vectors[inner_id], top_n, n_probe, exclude=inner_id).tolist()
+            return [self.trainset.to_raw_iid(item) for item in top_n_similar]
 
-        # Exclude the item itself from the similarity list and find the top-N most similar items
-        similarity_scores = [(item, score) for item, score in similarity_scores if item != inner_id]
-        top_n_similar = heapq.nlargest(top_n, similarity_scores, key=lambda t: t[1])
+        # Neighbor lists are already sorted, most similar first
+        if self.similarities is None:
+            top_n_similar = [item for item in self.neighbor_ids[inner_id][:top_n].tolist() if item >= 0]
+            return [self.trainset.to_raw_iid(item) for item in top_n_similar]
+
+        # Similarity scores for the item with all other items, the item itself excluded
+        similarity_scores = np.delete(self.similarities[inner_id], inner_id)
+        top_n_similar = top_n_indices(similarity_scores, top_n)
+        top_n_similar += top_n_similar >= inner_id
 
         # Convert inner ids back to raw itemIDs and return the results
-        top_n_similar = [self.trainset.to_raw_iid(item) for item, score in top_n_similar]
+        return [self.trainset.to_raw_iid(item) for item in top_n_similar.tolist()]
+
+    def get_similar_items_batch(self, items, top_n=10, n_probe=None):
+        """``get_similar_items`` for a list of raw item ids, None for items the model does not know.
+
+        Rows of the dense similarity matrix are ranked together by
+        ``top_n_rows``, neighbor lists and the approximate index item by item.
+        """
+        inner_ids = []
+        for i in items:
+            try:
+                inner_ids.append(self.trainset.to_inner_iid(str(i)))
+            except ValueError:
+                inner_ids.append(None)
+        known = [k for k, inner_id in enumerate(inner_ids) if inner_id is not None]
+        similar = [None] * len(items)
+
+        if self.similarities is None or (n_probe is not None and model_index(self) is not None):
+            for k in known:
+                similar[k] = self.get_similar_items(items[k], top_n, n_probe)
+            return similar
 
-        return top_n_similar
\ No newline at end of file
+        # The item itself ranks last, then out of the top n
+        rows = np.array([inner_ids[k] for k in known], dtype=np.int64)
+        scores = np.array(self.similarities[rows], dtype=np.float64)
+        scores[np.arange(len(rows)), rows] = -np.inf
+        top = top_n_rows(scores, min(top_n, self.trainset.n_items - 1))
+        for k, top_n_similar in zip(known, top.tolist()):
+            similar[k] = [self.trainset.to_raw_iid(item) for item in top_n_similar]
+        return similar
@@ -0,0 +1,45 @@
+from RecSys.ContentKNNAlgorithm import ContentKNNAlgorithm, tag_similarity_blocks
+from scipy import sparse
+import numpy as np
+import random
+import time
+
+# Set random seeds for reproducibility
+np.random.seed(0)
+random.seed(0)
+
+# Synthetic catalog: 50k products with 1-6 tags out of 300
+n_products, n_tags = 50000, 300
+tag_lists = [random.sample(range(n_tags), random.randint(1, 6)) for _ in range(n_products)]
+indptr = np.cumsum([0] + [len(t) for t in tag_lists])
+indices = np.concatenate([sorted(t) for t in tag_lists])
+tag_matrix = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n_products, n_tags))
+tags = {p: tag_matrix[p].toarray().ravel().astype(int).tolist() for p in range(n_products)}
+
+# Legacy pairwise loop on a sample of pairs, extrapolated to every pair
+algo = ContentKNNAlgorithm()
+n_pairs = 20000
+pairs = [(random.randrange(n_products), random.randrange(n_products)) for _ in range(n_pairs)]
+start = time.perf_counter()
+legacy = [algo.computeTagSimilarity(a, b, tags) for a, b in pairs]
+legacy_seconds = (time.perf_counter() - start) / n_pairs * n_products * (n_products - 1) / 2
+
+# Sparse block products over the full catalog
+start = time.perf_counter()
+sampled = {}
+for block_start, block_end, block in tag_similarity_blocks(tag_matrix, block_size=500):
+    for a, b in pairs:
+        if block_start <= a < block_end:
+            sampled[(a, b)] = block[a - block_start, b]
+vectorized_seconds = time.perf_counter() - start
+
+# The diagonal is 0 in the model, the legacy helper returns 1 for a == b
+identical = all(sampled[(a, b)] == (s if a != b else 0) for (a, b), s in zip(pairs, legacy))
+
+print(f"Legacy loop (extrapolated): {legacy_seconds:.0f}s")
+print(f"Sparse blocks: {vectorized_seconds:.1f}s")
+print(f"Speedup: {legacy_seconds / vectorized_seconds:.0f}x, identical: {identical}")
+
+# Legacy loop (extrapolated): 50151s
+# Sparse blocks: 28.6s
+# Speedup: 1755x, identical: True
\ No newline at end of file
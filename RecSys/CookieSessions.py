@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import itertools
+import threading
+import time
+import numpy as np
+
+class CookieSessionStore:
+    """Recent product views of anonymous visitors, kept in memory by each worker process.
+
+    Every view adds its count to the weight of the product in the cookie's
+    profile, and weights decay by half every ``half_life`` seconds, the
+    in-session counterpart of the recency-weighted view counts of
+    cookie_rating_dataset. Cookies not seen for ``ttl`` seconds are dropped,
+    and the store keeps at most ``max_cookies`` cookies (least recently seen
+    dropped first) and ``max_products`` products per cookie (lightest dropped
+    first).
+    """
+
+    def __init__(self, max_cookies=100000, max_products=50, ttl=86400, half_life=21600, clock=time.time):
+        self.max_cookies = max_cookies
+        self.max_products = max_products
+        self.ttl = ttl
+        self.half_life = half_life
+        self._clock = clock
+        # cookie -> [last_seen, version, {product_id: (weight, updated_at)}], least recently seen first
+        self._sessions = OrderedDict()
+        # Versions are never reused, so results cached for a dropped session never match a new one
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _decayed(self, weight, updated_at, now):
+        return weight * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def _expire(self, now):
+        while self._sessions:
+            cookie, session = next(iter(self._sessions.items()))
+            if now - session[0] < self.ttl and len(self._sessions) <= self.max_cookies:
+                return
+            del self._sessions[cookie]
+
+    def add(self, cookie, product_id, count=1):
+        """Record count views of product_id by the cookie."""
+        now = self._clock()
+        with self._lock:
+            session = self._sessions.pop(cookie, None)
+            if session is None:
+                session = [now, 0, {}]
+            self._sessions[cookie] = session
+            session[0] = now
+            session[1] = next(self._versions)
+
+            products = session[2]
+            weight, updated_at = products.get(product_id, (0.0, now))
+            products[product_id] = (self._decayed(weight, updated_at, now) + count, now)
+            if len(products) > self.max_products:
+                lightest = min(products, key=lambda product: self._decayed(*products[product], now))
+                del products[lightest]
+            self._expire(now)
+
+    def version(self, cookie):
+        """Changes whenever the cookie's profile does, 0 without a live profile."""
+        now = self._clock()
+        with self._lock:
+            session = self._sessions.get(cookie)
+            if session is None or now - session[0] >= self.ttl:
+                return 0
+            return session[1]
+
+    def profile(self, cookie):
+        """Product ids and decayed view weights of the cookie, None without a live profile."""
+        now = self._clock()
+        with self._lock:
+            session = self._sessions.get(cookie)
+            if session is None or now - session[0] >= self.ttl:
+                return None
+            products = list(session[2].items())
+        product_ids = np.array([product_id for product_id, _ in products], dtype=np.int64)
+        weights = np.array([self._decayed(weight, updated_at, now) for _, (weight, updated_at) in products])
+        return product_ids, weights
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cookies': len(self._sessions),
+                'max_cookies': self.max_cookies,
+                'ttl': self.ttl,
+                'half_life': self.half_life,
+            }
@@ -0,0 +1,70 @@
+from RecSys import DatasetStore
+from RecSys.ProductPreference import ProductInfo
+from surprise import Dataset
+from surprise import Reader
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+import time
+import tracemalloc
+
+# Set random seeds for reproducibility
+np.random.seed(0)
+
+# Synthetic rating dataset the size of the production one (~11 MB of CSV)
+n_ratings = 500000
+ratings = pd.DataFrame({
+    'userId': np.random.randint(1, 60000, n_ratings).astype(str),
+    'productId': np.random.randint(1, 20000, n_ratings).astype(str),
+    'rating': np.random.uniform(1, 5, n_ratings),
+})
+
+def measure(load, memory=True):
+    start = time.perf_counter()
+    result = load()
+    seconds = time.perf_counter() - start
+    if not memory:
+        return result, seconds, None
+
+    # Second run for the memory, tracing slows allocations down
+    tracemalloc.start()
+    load()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    DatasetStore.DATASET_DIR = tmp_dir
+    ratings.to_csv(DatasetStore.dataset_path('rating_dataset', 'csv'), index=False)
+    DatasetStore.save_dataset(ratings, 'rating_dataset')
+    # loadRatingData also maps the product names
+    DatasetStore.save_dataset(pd.DataFrame({'productId': [1], 'productName': ['Product 1']}), 'product_dataset')
+    csv_mb = os.path.getsize(DatasetStore.dataset_path('rating_dataset', 'csv')) / 2**20
+    parquet_mb = os.path.getsize(DatasetStore.dataset_path('rating_dataset')) / 2**20
+
+    # DataFrame readers, e.g. the favorite items and catalog loads
+    csv_df, csv_seconds, csv_peak = measure(
+        lambda: pd.read_csv(DatasetStore.dataset_path('rating_dataset', 'csv')))
+    parquet_df, parquet_seconds, parquet_peak = measure(
+        lambda: DatasetStore.load_dataset('rating_dataset'))
+
+    # Training input, text parsing by surprise against the typed columns
+    reader = Reader(line_format='user item rating', sep=',', skip_lines=1)
+    _, surprise_csv_seconds, _ = measure(lambda: Dataset.load_from_file(
+        DatasetStore.dataset_path('rating_dataset', 'csv'), reader=reader).build_full_trainset(), memory=False)
+    _, surprise_parquet_seconds, _ = measure(lambda: ProductInfo().loadRatingData().build_full_trainset(),
+                                             memory=False)
+
+print(f"File size: CSV {csv_mb:.1f} MB, Parquet {parquet_mb:.1f} MB")
+print(f"DataFrame load: CSV {csv_seconds:.3f}s, Parquet {parquet_seconds:.3f}s")
+print(f"DataFrame memory: CSV {csv_df.memory_usage(deep=True).sum() / 2**20:.1f} MB, "
+      f"Parquet {parquet_df.memory_usage(deep=True).sum() / 2**20:.1f} MB")
+print(f"Peak Python allocations: CSV {csv_peak:.1f} MB, Parquet {parquet_peak:.1f} MB")
+print(f"Trainset build: CSV {surprise_csv_seconds:.2f}s, Parquet {surprise_parquet_seconds:.2f}s")
+
+# File size: CSV 14.2 MB, Parquet 4.6 MB
+# DataFrame load: CSV 0.193s, Parquet 0.023s
+# DataFrame memory: CSV 11.4 MB, Parquet 5.7 MB
+# Peak Python allocations: CSV 15.3 MB, Parquet 4.6 MB
+# Trainset build: CSV 2.12s, Parquet 2.06s
\ No newline at end of file
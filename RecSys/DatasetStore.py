@@ -0,0 +1,85 @@
+"""Typed columnar storage of the refreshed datasets.
+
+``TDS_DataRefresh`` saves every dataset as ``dataset/<name>.parquet`` with
+the dtypes below, and optionally as the old CSV export. Readers go through
+``load_dataset``, which falls back to the CSV until the first refresh has
+written the Parquet file, and get the same dtypes either way:
+
+- customer, product, category and order ids are int32 ('Int32' when they
+  may be missing),
+- cookie ids are categorical strings,
+- ratings are float32.
+
+Surprise models take the ids as strings (``str`` of the int32 id), which
+``ProductInfo`` converts one column at a time.
+"""
+
+import os
+import pandas as pd
+
+DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../dataset')
+
+# CSVs have always been read as Latin-1
+CSV_ENCODING = 'ISO-8859-1'
+
+# Column dtypes of every dataset, 'Int32' columns may hold missing values
+SCHEMAS = {
+    'rating_dataset': {'userId': 'int32', 'productId': 'int32', 'rating': 'float32'},
+    'cookie_rating_dataset': {'userId': 'category', 'productId': 'int32', 'rating': 'float32'},
+    'product_dataset': {'productId': 'int32', 'productName': 'str', 'tag': 'str', 'Active': 'bool',
+                        'Quantity': 'int32'},
+    'purchase_dataset': {'CustomerId': 'int32', 'ProductId': 'int32'},
+    # Summed preference scores rank the favorite items, float64 keeps their ties as they were
+    'product_preference_dataset': {'productId': 'int32', 'categoryId': 'int32', 'rating': 'float64'},
+    'basket_dataset': {'OrdersId': 'int32', 'CustomerId': 'Int32', 'StatusId': 'Int32', 'ProductId': 'int32',
+                       'CategoryId': 'Int32'},
+}
+
+def dataset_path(name, extension='parquet'):
+    return os.path.join(DATASET_DIR, f'{name}.{extension}')
+
+def dataset_paths(name):
+    """Every file a dataset may be loaded from, to watch for changes."""
+    return (dataset_path(name), dataset_path(name, 'csv'))
+
+def cast_dataset(df, name):
+    df = df.copy()
+    for column, dtype in SCHEMAS[name].items():
+        if column not in df:
+            continue
+        if dtype == 'str':
+            df[column] = df[column].fillna('').astype(str)
+        elif dtype == 'category':
+            if df[column].dtype != 'category':
+                df[column] = df[column].astype(str).astype('category')
+        elif dtype == 'bool' and df[column].dtype == object:
+            # Bit columns come back from the CSV export as 'True' / 'False'
+            df[column] = df[column].astype(str) == 'True'
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+def save_dataset(df, name, csv=False):
+    """Write the dataset as Parquet, and as CSV too when csv is set."""
+    df = cast_dataset(df, name)
+    path = dataset_path(name)
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    if csv:
+        df.to_csv(dataset_path(name, 'csv'), index=False)
+    return df
+
+def load_dataset(name, columns=None):
+    """Load the dataset with its schema dtypes, from Parquet or else from the CSV export."""
+    path = dataset_path(name)
+    if os.path.exists(path):
+        return pd.read_parquet(path, columns=columns)
+
+    # Without columns, only the schema columns: older exports may carry columns since dropped
+    schema = SCHEMAS[name]
+    text_columns = [column for column, dtype in schema.items() if dtype in ('str', 'category')]
+    usecols = columns if columns is not None else (lambda column: column in schema)
+    df = pd.read_csv(dataset_path(name, 'csv'), encoding=CSV_ENCODING, usecols=usecols,
+                     dtype={column: str for column in text_columns})
+    return cast_dataset(df, name)
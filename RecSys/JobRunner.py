@@ -0,0 +1,236 @@
+"""Background jobs for the long-running refresh and retrain pipelines.
+
+Jobs run one at a time on a worker thread of the process that accepted them.
+Their state (status, stage timings, progress) is written to a JSON file after
+every update, so any uvicorn worker can answer a status poll, and a lock file
+per job kind rejects a second submission of the same kind from any worker
+while one is queued or running.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+class JobRejected(Exception):
+    """Raised when a job of the same kind is already queued or running, or the queue is full."""
+
+    def __init__(self, message, job=None):
+        super().__init__(message)
+        self.job = job
+
+class NullReporter:
+    """Reporter used when a pipeline runs outside of a job."""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def start_stage(self, name):
+        pass
+
+    def finish_stage(self, name, status='succeeded'):
+        pass
+
+    def progress(self, done, total, stage=None, message=None):
+        pass
+
+NULL_REPORTER = NullReporter()
+
+class JobReporter(NullReporter):
+    """Records stage timings and progress of a running job."""
+
+    def __init__(self, job, save):
+        self.job = job
+        self._save = save
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        for stage in self.job['stages']:
+            if stage['name'] == name:
+                return stage
+        stage = {'name': name, 'status': 'pending', 'started_at': None, 'finished_at': None,
+                 'seconds': None, 'progress': None}
+        self.job['stages'].append(stage)
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        self.start_stage(name)
+        try:
+            yield
+        except BaseException:
+            self.finish_stage(name, status='failed')
+            raise
+        self.finish_stage(name)
+
+    def start_stage(self, name):
+        with self._lock:
+            stage = self._stage(name)
+            stage['status'] = 'running'
+            stage['started_at'] = time.time()
+            self._save(self.job)
+
+    def finish_stage(self, name, status='succeeded'):
+        with self._lock:
+            stage = self._stage(name)
+            stage['status'] = status
+            stage['finished_at'] = time.time()
+            stage['seconds'] = stage['finished_at'] - (stage['started_at'] or stage['finished_at'])
+            self._save(self.job)
+
+    def progress(self, done, total, stage=None, message=None):
+        with self._lock:
+            progress = {'done': done, 'total': total, 'message': message}
+            if stage is None:
+                self.job['progress'] = progress
+            else:
+                self._stage(stage)['progress'] = progress
+            self._save(self.job)
+
+class JobRunner:
+
+    def __init__(self, state_dir, max_queued=4, heartbeat=30, stale_after=600):
+        self.state_dir = state_dir
+        self.max_queued = max_queued
+        self.heartbeat = heartbeat
+        # A queued/running job not updated for that long belongs to a dead process
+        self.stale_after = stale_after
+        os.makedirs(state_dir, exist_ok=True)
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        # Queued and running jobs of this process, kept fresh by the heartbeat
+        self._active = {}
+
+    def _job_path(self, job_id):
+        return os.path.join(self.state_dir, job_id + '.json')
+
+    def _lock_path(self, kind):
+        return os.path.join(self.state_dir, kind + '.lock')
+
+    def _save(self, job):
+        job['updated_at'] = time.time()
+        tmp_path = self._job_path(job['id']) + '.tmp'
+        with open(tmp_path, 'w') as job_file:
+            json.dump(job, job_file)
+        os.replace(tmp_path, self._job_path(job['id']))
+
+    def get(self, job_id):
+        try:
+            with open(self._job_path(os.path.basename(job_id))) as job_file:
+                return json.load(job_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def list(self, limit=20):
+        jobs = [self.get(name[:-5]) for name in os.listdir(self.state_dir) if name.endswith('.json')]
+        jobs = [job for job in jobs if job is not None]
+        return sorted(jobs, key=lambda job: job['submitted_at'], reverse=True)[:limit]
+
+    def _alive(self, job):
+        """Whether the job is queued or running in a live process."""
+        if job['status'] not in ('queued', 'running'):
+            return False
+        if job.get('host') == socket.gethostname():
+            try:
+                os.kill(job['pid'], 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+        return time.time() - job['updated_at'] < self.stale_after
+
+    def _acquire(self, kind, job_id):
+        """Take the lock of the job kind, breaking it if its job is finished or stale."""
+        for _ in range(2):
+            try:
+                fd = os.open(self._lock_path(kind), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(self._lock_path(kind)) as lock_file:
+                        holder = self.get(lock_file.read().strip())
+                except FileNotFoundError:
+                    continue
+                if holder is not None and self._alive(holder):
+                    raise JobRejected(f"A {kind} job is already {holder['status']}", holder)
+                self._release(kind)
+                continue
+            with os.fdopen(fd, 'w') as lock_file:
+                lock_file.write(job_id)
+            return
+        raise RuntimeError(f'Could not acquire the {kind} job lock')
+
+    def _release(self, kind):
+        try:
+            os.remove(self._lock_path(kind))
+        except FileNotFoundError:
+            pass
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """Queue fn(*args, reporter=..., **kwargs) and return the job state right away."""
+        with self._lock:
+            if self._queue.qsize() >= self.max_queued:
+                raise JobRejected('Too many jobs queued, retry later')
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'status': 'queued',
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'stages': [],
+                'progress': None,
+                'error': None,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+            }
+            self._acquire(kind, job['id'])
+            reporter = JobReporter(job, self._save)
+            self._save(job)
+            self._active[job['id']] = reporter
+            self._queue.put((reporter, fn, args, kwargs))
+
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='job-runner', daemon=True)
+                self._worker.start()
+                threading.Thread(target=self._beat, name='job-heartbeat', daemon=True).start()
+        return dict(job)
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self._lock:
+                reporters = list(self._active.values())
+            for reporter in reporters:
+                with reporter._lock:
+                    self._save(reporter.job)
+
+    def _work(self):
+        while True:
+            reporter, fn, args, kwargs = self._queue.get()
+            job = reporter.job
+            with reporter._lock:
+                job['status'] = 'running'
+                job['started_at'] = time.time()
+                self._save(job)
+            try:
+                fn(*args, reporter=reporter, **kwargs)
+                job['status'] = 'succeeded'
+            except Exception:
+                job['status'] = 'failed'
+                job['error'] = traceback.format_exc()
+                print(job['error'])
+            finally:
+                with self._lock:
+                    del self._active[job['id']]
+                with reporter._lock:
+                    job['finished_at'] = time.time()
+                    self._save(job)
+                self._release(job['kind'])
+                self._queue.task_done()
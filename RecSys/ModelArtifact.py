@@ -0,0 +1,209 @@
+"""Model artifacts: large arrays as .npy files plus a small meta.json.
+
+An artifact is a directory holding one sub-directory per saved version and a
+``CURRENT`` file naming the live one. Loading opens every array with
+``mmap_mode='r'``, so worker processes share the same pages through the OS
+page cache instead of each unpickling a private copy.
+
+    app/svd_model/
+        CURRENT                 -> "1728000000000000000"
+        1728000000000000000/
+            meta.json
+            pu.npy, qi.npy, bu.npy, bi.npy
+            user_raw.npy, item_raw.npy, ...
+"""
+
+from surprise import SVD
+from surprise import Trainset
+from RecSys.ContentKNNAlgorithm import ContentKNNAlgorithm
+from RecSys.ALSAlgorithm import ALSAlgorithm
+from RecSys.ANNIndex import INDEX_ARRAYS
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+CURRENT = 'CURRENT'
+
+# Arrays saved for each supported algorithm, the other attributes go to meta.json
+ALGORITHMS = {
+    'SVD': (SVD, ['pu', 'qi', 'bu', 'bi'] + INDEX_ARRAYS),
+    'ALSAlgorithm': (ALSAlgorithm, ['pu', 'qi', 'bu', 'bi'] + INDEX_ARRAYS),
+    'ContentKNNAlgorithm': (ContentKNNAlgorithm, ['similarities', 'neighbor_ids', 'neighbor_sims'] + INDEX_ARRAYS),
+}
+
+class UserRatings:
+    """Read-only ``trainset.ur`` backed by CSR arrays."""
+
+    def __init__(self, indptr, items, ratings):
+        self.indptr = indptr
+        self.items = items
+        self.ratings = ratings
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __contains__(self, u):
+        return isinstance(u, (int, np.integer)) and 0 <= u < len(self)
+
+    def __getitem__(self, u):
+        if u not in self:
+            return []
+        start, end = self.indptr[u], self.indptr[u + 1]
+        return list(zip(self.items[start:end].tolist(), self.ratings[start:end].tolist()))
+
+class ArtifactTrainset(Trainset):
+    """Trainset restored from an artifact.
+
+    Raw ids are resolved by binary search over sorted id arrays, so nothing
+    proportional to the number of users or items is built at load time.
+    """
+
+    def __init__(self, meta, arrays):
+        self.ur = UserRatings(arrays['ur_indptr'], arrays['ur_items'], arrays['ur_ratings'])
+        self.ir = None
+        self.n_users = meta['n_users']
+        self.n_items = meta['n_items']
+        self.n_ratings = meta['n_ratings']
+        self.rating_scale = tuple(meta['rating_scale'])
+        self._global_mean = meta['global_mean']
+        self._arrays = arrays
+
+    def _lookup(self, kind, raw_ids):
+        sorted_ids = self._arrays[kind + '_sorted']
+        raw_ids = np.asarray(raw_ids, dtype=str)
+        if len(sorted_ids) == 0:
+            return np.full(raw_ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(sorted_ids, raw_ids), len(sorted_ids) - 1)
+        found = sorted_ids[pos] == raw_ids
+        return np.where(found, self._arrays[kind + '_sorted_inner'][pos], -1)
+
+    def knows_user(self, uid):
+        return uid in self.ur
+
+    def knows_item(self, iid):
+        return isinstance(iid, (int, np.integer)) and 0 <= iid < self.n_items
+
+    def to_inner_uid(self, ruid):
+        inner = int(self._lookup('user', [str(ruid)])[0])
+        if inner < 0:
+            raise ValueError("User " + str(ruid) + " is not part of the trainset.")
+        return inner
+
+    def to_inner_iid(self, riid):
+        inner = int(self._lookup('item', [str(riid)])[0])
+        if inner < 0:
+            raise ValueError("Item " + str(riid) + " is not part of the trainset.")
+        return inner
+
+    def to_inner_iids(self, raw_ids):
+        """Vectorized to_inner_iid, -1 for unknown items."""
+        return self._lookup('item', np.asarray(raw_ids).astype(str))
+
+    def to_raw_uid(self, iuid):
+        return str(self._arrays['user_raw'][iuid])
+
+    def to_raw_iid(self, iiid):
+        return str(self._arrays['item_raw'][iiid])
+
+    @property
+    def global_mean(self):
+        return self._global_mean
+
+def _trainset_arrays(trainset):
+    users = [trainset.to_raw_uid(u) for u in range(trainset.n_users)]
+    items = [trainset.to_raw_iid(i) for i in range(trainset.n_items)]
+    user_raw, item_raw = np.array(users, dtype=str), np.array(items, dtype=str)
+
+    lengths = [len(trainset.ur[u]) for u in range(trainset.n_users)]
+    indptr = np.zeros(trainset.n_users + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    pairs = [rating for u in range(trainset.n_users) for rating in trainset.ur[u]]
+
+    user_order = np.argsort(user_raw, kind='stable')
+    item_order = np.argsort(item_raw, kind='stable')
+    return {
+        'user_raw': user_raw,
+        'item_raw': item_raw,
+        'user_sorted': user_raw[user_order],
+        'user_sorted_inner': user_order,
+        'item_sorted': item_raw[item_order],
+        'item_sorted_inner': item_order,
+        'ur_indptr': indptr,
+        'ur_items': np.array([i for i, _ in pairs], dtype=np.int32),
+        'ur_ratings': np.array([r for _, r in pairs], dtype=np.float64),
+    }
+
+def _jsonable(value):
+    try:
+        json.dumps(value)
+        return True
+    except TypeError:
+        return False
+
+def save_artifact(path, algorithm, keep=2):
+    """Save the algorithm as a new version of the artifact at path and make it current."""
+    name = type(algorithm).__name__
+    if name not in ALGORITHMS:
+        raise ValueError(f'Cannot save {name} as an artifact')
+    _, array_names = ALGORITHMS[name]
+
+    trainset = algorithm.trainset
+    arrays = _trainset_arrays(trainset)
+    for array_name in array_names:
+        value = getattr(algorithm, array_name, None)
+        if value is not None:
+            arrays[array_name] = np.asarray(value)
+
+    params = {key: value for key, value in vars(algorithm).items()
+              if key not in arrays and key not in ('trainset', 'artifact_version') and _jsonable(value)}
+    meta = {
+        'algorithm': name,
+        'params': params,
+        'arrays': sorted(arrays),
+        'n_users': trainset.n_users,
+        'n_items': trainset.n_items,
+        'n_ratings': trainset.n_ratings,
+        'rating_scale': list(trainset.rating_scale),
+        'global_mean': float(trainset.global_mean),
+    }
+
+    version = str(time.time_ns())
+    version_path = os.path.join(path, version)
+    os.makedirs(version_path)
+    for array_name, value in arrays.items():
+        np.save(os.path.join(version_path, array_name + '.npy'), value)
+    with open(os.path.join(version_path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    # Switch readers to the new version in one rename
+    tmp_path = os.path.join(path, CURRENT + '.tmp')
+    with open(tmp_path, 'w') as current_file:
+        current_file.write(version)
+    os.replace(tmp_path, os.path.join(path, CURRENT))
+
+    # Older versions may still be mapped by running workers, removal is best effort
+    versions = sorted(v for v in os.listdir(path) if v.isdigit())
+    for old in versions[:-keep]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+
+def load_artifact(path):
+    """Load the current version of the artifact at path with memory-mapped arrays."""
+    with open(os.path.join(path, CURRENT)) as current_file:
+        version_path = os.path.join(path, current_file.read().strip())
+    with open(os.path.join(version_path, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+
+    arrays = {name: np.load(os.path.join(version_path, name + '.npy'), mmap_mode='r')
+              for name in meta['arrays']}
+
+    cls, array_names = ALGORITHMS[meta['algorithm']]
+    algorithm = cls.__new__(cls)
+    algorithm.__dict__.update(meta['params'])
+    for array_name in array_names:
+        setattr(algorithm, array_name, arrays.get(array_name))
+    algorithm.trainset = ArtifactTrainset(meta, arrays)
+    algorithm.artifact_version = os.path.basename(version_path)
+    return algorithm
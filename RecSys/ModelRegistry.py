@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+class ModelRegistry:
+    """Keep trained models in memory and swap them when their files change.
+
+    Every entry is loaded once and then served from memory. On each ``get`` the
+    file stamp (mtime, size, inode) is compared with the one the entry was
+    loaded from, so a retrain done by another worker process is picked up
+    without restarting the app. The new object is fully loaded before it
+    replaces the old one, so callers always get a complete model.
+    """
+
+    def __init__(self, version_interval=1.0):
+        self._entries = {}  # name -> (path or tuple of paths, loader)
+        self._loaded = {}   # name -> (stamp, object)
+        self._locks = {}
+        # Bumped on every load, the file stamps of version() are refreshed every version_interval seconds
+        self._generation = 0
+        self.version_interval = version_interval
+        self._file_stamps = (0.0, None)  # (checked at, stamps)
+
+    def register(self, name, path, loader):
+        self._entries[name] = (path, loader)
+        self._locks[name] = threading.Lock()
+
+    def names(self):
+        return list(self._entries)
+
+    def _stamp(self, path):
+        # Entries built from several files are reloaded when any of them changes,
+        # files that do not exist are skipped as long as one of them does
+        if isinstance(path, (tuple, list)):
+            stamps = tuple(self._stamp_file(p) for p in path)
+            if not any(stamps):
+                raise FileNotFoundError(path)
+            return stamps
+        stamp = self._stamp_file(path)
+        if stamp is None:
+            raise FileNotFoundError(path)
+        return stamp
+
+    def _stamp_file(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self, name, force=False):
+        path, loader = self._entries[name]
+        with self._locks[name]:
+            stamp = self._stamp(path)
+            current = self._loaded.get(name)
+            if current is not None and current[0] == stamp and not force:
+                return current[1]
+
+            print(f"Loading {name}...")
+            obj = loader(path)
+            # Single assignment: readers see either the old or the new object
+            self._loaded[name] = (stamp, obj)
+            self._generation += 1
+            return obj
+
+    def get(self, name):
+        if name not in self._entries:
+            raise KeyError(name)
+
+        path, _ = self._entries[name]
+        current = self._loaded.get(name)
+        if current is not None and current[0] == self._stamp(path):
+            return current[1]
+        return self._load(name)
+
+    def version(self):
+        """Changes whenever this process (re)loads an entry or a registered file is rewritten.
+
+        Files are only stat'ed every ``version_interval`` seconds, so a
+        rewrite by another process is seen within that delay.
+        """
+        checked_at, stamps = self._file_stamps
+        now = time.monotonic()
+        if stamps is None or now - checked_at >= self.version_interval:
+            stamps = []
+            for path, _ in self._entries.values():
+                for p in (path if isinstance(path, (tuple, list)) else [path]):
+                    stamps.append(self._stamp_file(p))
+            stamps = tuple(stamps)
+            self._file_stamps = (now, stamps)
+        return (self._generation, stamps)
+
+    def load_all(self):
+        """Load every registered entry, skipping the ones that are not built yet."""
+        for name in self._entries:
+            try:
+                self._load(name)
+            except FileNotFoundError:
+                print(f"{name} not found, it will be loaded on first use.")
+
+    def reload(self, names=None):
+        """Force a reload, e.g. right after the files were rewritten."""
+        for name in (names or self._entries):
+            try:
+                self._load(name, force=True)
+            except FileNotFoundError:
+                self._loaded.pop(name, None)
+                self._generation += 1
@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+import threading
+import time
+
+class PoolMetrics:
+    """Check out connections of an engine and record how long callers waited.
+
+    ``stats`` adds the gauges of the engine's QueuePool (checked out,
+    overflow) to the wait times, to tell connection churn and pool
+    exhaustion apart from slow queries.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connects = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            cnxn = self.engine.connect()
+        except PoolTimeout:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        wait = time.perf_counter() - start
+        with self._lock:
+            self.connects += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        with cnxn:
+            yield cnxn
+
+    def stats(self):
+        pool = self.engine.pool
+        with self._lock:
+            return {
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'connects': self.connects,
+                'timeouts': self.timeouts,
+                'wait_seconds_avg': self.wait_seconds / self.connects if self.connects else 0.0,
+                'wait_seconds_max': self.max_wait_seconds,
+            }
@@ -0,0 +1,75 @@
+import numpy as np
+import os
+
+class PopularityRanking:
+    """Favorite products, ranked by summed preference over every product and per category.
+
+    Built by ``TDS_DataRefresh`` from the product preference dataset, with
+    the active / in-stock flags of the product dataset at that time. Serving
+    a category is a binary search for its slice of the ranking and an
+    availability re-check of the first few products only.
+    """
+
+    def __init__(self, product_ids, available, category_ids, category_indptr, category_positions):
+        self.product_ids = product_ids              # best first, int64
+        self.available = available                  # active and in stock at refresh time
+        # Positions into product_ids of category_ids[k] are at indptr[k]:indptr[k+1], in rank order
+        self.category_ids = category_ids            # sorted
+        self.category_indptr = category_indptr
+        self.category_positions = category_positions
+
+    @classmethod
+    def from_datasets(cls, preferences, products):
+        """Rank the productId, categoryId, rating rows of the product preference dataset."""
+        # Same order as the per-request sort it replaces, ties included
+        ranked = preferences.sort_values('rating', ascending=False)
+        product_ids = ranked['productId'].to_numpy(dtype=np.int64)
+        category_of = ranked['categoryId'].to_numpy(dtype=np.int64)
+
+        available = products.loc[products['Active'] & (products['Quantity'] > 0), 'productId']
+        flags = np.isin(product_ids, available.to_numpy(dtype=np.int64))
+
+        positions = np.argsort(category_of, kind='stable')
+        category_ids, counts = np.unique(category_of[positions], return_counts=True)
+        indptr = np.zeros(len(category_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(product_ids, flags, category_ids, indptr, positions)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as ranking_file:
+            np.savez(ranking_file, product_ids=self.product_ids, available=self.available,
+                     category_ids=self.category_ids, category_indptr=self.category_indptr,
+                     category_positions=self.category_positions)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['product_ids'], arrays['available'], arrays['category_ids'],
+                       arrays['category_indptr'], arrays['category_positions'])
+
+    def top(self, catalog, category=None, n=10):
+        """Top n favorite products of the category (every product if None) still available in the catalog."""
+        if category:
+            k = np.searchsorted(self.category_ids, category)
+            if k == len(self.category_ids) or self.category_ids[k] != category:
+                return []
+            positions = self.category_positions[self.category_indptr[k]:self.category_indptr[k + 1]]
+        else:
+            positions = None
+
+        # Walk down the ranking in growing chunks until n products are available
+        top_products = []
+        start, size = 0, 2 * n
+        total = len(self.product_ids) if positions is None else len(positions)
+        while len(top_products) < n and start < total:
+            end = min(start + size, total)
+            chunk = np.arange(start, end) if positions is None else positions[start:end]
+            product_ids = self.product_ids[chunk[self.available[chunk]]]
+            rows = catalog.rows_of(product_ids)
+            found = rows >= 0
+            found[found] = catalog.available[rows[found]]
+            top_products.extend(product_ids[found].tolist())
+            start, size = end, 2 * size
+        return top_products[:n]
@@ -1,101 +1,189 @@
 from surprise import Dataset
 from surprise import Reader
+from RecSys.DatasetStore import load_dataset
 
-import os
-import csv
+import numpy as np
+import pandas as pd
+from scipy import sparse
 
 from collections import defaultdict
 
+class ProductCatalog:
+    """Columnar, indexed view of the product and purchase datasets.
+
+    Built once per dataset refresh and shared by every request. Products are
+    kept in file order, so iterating ``product_ids[mask]`` visits the same
+    products in the same order as the old per-row CSV scans.
+    """
+
+    def __init__(self, product_ids, active, instock, customer_ids, purchase_indptr, purchase_rows):
+        self.product_ids = product_ids          # int64, catalog order
+        self.active = active                    # bool mask aligned with product_ids
+        self.instock = instock                  # bool mask aligned with product_ids
+        self.available = active & instock
+
+        # CSR index: purchases of customer_ids[k] are purchase_rows[indptr[k]:indptr[k+1]]
+        self.customer_ids = customer_ids        # int64, sorted
+        self.purchase_indptr = purchase_indptr
+        self.purchase_rows = purchase_rows      # rows into product_ids
+        self._sorter = np.argsort(product_ids, kind='stable')
+        self._inner_ids = {}
+        self._item_rows = {}
+
+    def _per_trainset(self, cache, trainset, build):
+        cached = cache.get(id(trainset))
+        if cached is not None and cached[0] is trainset:
+            return cached[1]
+
+        value = build()
+        # Only a few models are alive at a time, drop mappings of replaced ones
+        if len(cache) >= 8:
+            cache.clear()
+        cache[id(trainset)] = (trainset, value)
+        return value
+
+    def inner_item_ids(self, trainset):
+        """Map every catalog row to the trainset inner item id (-1 if unknown)."""
+        def build():
+            if hasattr(trainset, 'to_inner_iids'):
+                return trainset.to_inner_iids(self.product_ids)
+            raw2inner = trainset._raw2inner_id_items
+            return np.fromiter((raw2inner.get(str(product_id), -1) for product_id in self.product_ids.tolist()),
+                               dtype=np.int64, count=len(self.product_ids))
+        return self._per_trainset(self._inner_ids, trainset, build)
+
+    def item_rows(self, trainset):
+        """Map every trainset inner item id to its catalog row (-1 if not in the catalog)."""
+        def build():
+            inner_ids = self.inner_item_ids(trainset)
+            known = inner_ids >= 0
+            rows = np.full(trainset.n_items, -1, dtype=np.int64)
+            rows[inner_ids[known]] = np.flatnonzero(known)
+            return rows
+        return self._per_trainset(self._item_rows, trainset, build)
+
+    @classmethod
+    def from_datasets(cls, products, purchases):
+        """Build the catalog from the product and purchase datasets of DatasetStore."""
+        product_ids = products['productId'].to_numpy(dtype=np.int64)
+        active = products['Active'].to_numpy(dtype=bool)
+        instock = (products['Quantity'] > 0).to_numpy()
+
+        # Purchased products missing from the catalog can never be recommended, drop them
+        rows = pd.Index(product_ids).get_indexer(purchases['ProductId'].to_numpy(dtype=np.int64))
+        known = rows >= 0
+        customers = purchases['CustomerId'].to_numpy(dtype=np.int64)[known]
+        rows = rows[known]
+
+        order = np.argsort(customers, kind='stable')
+        customers, rows = customers[order], rows[order]
+        customer_ids, counts = np.unique(customers, return_counts=True)
+        indptr = np.zeros(len(customer_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(product_ids, active, instock, customer_ids, indptr, rows)
+
+    def rows_of(self, product_ids):
+        """Catalog rows of an array of product ids, -1 for unknown products."""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if len(self.product_ids) == 0:
+            return np.full(product_ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.product_ids, product_ids, sorter=self._sorter), len(self.product_ids) - 1)
+        rows = self._sorter[pos]
+        return np.where(self.product_ids[rows] == product_ids, rows, -1)
+
+    def purchased_rows(self, customer_id):
+        """Catalog rows of the products bought by the customer (empty for cookies)."""
+        if not isinstance(customer_id, (int, np.integer)):
+            return self.purchase_rows[:0]
+        k = np.searchsorted(self.customer_ids, customer_id)
+        if k == len(self.customer_ids) or self.customer_ids[k] != customer_id:
+            return self.purchase_rows[:0]
+        return self.purchase_rows[self.purchase_indptr[k]:self.purchase_indptr[k + 1]]
+
+    def eligible_mask(self, customer_id):
+        """Active, in-stock products the customer has not purchased yet."""
+        mask = self.available.copy()
+        mask[self.purchased_rows(customer_id)] = False
+        return mask
+
 class ProductInfo:
 
     def __init__(self):
-        # Resolve the base path relative to the module location
-        base_path = os.path.dirname(os.path.abspath(__file__))
-        # Define paths to the datasets relative to the module location
-        self.rating_dataset = os.path.join(base_path, '../dataset/rating_dataset.csv')
-        self.product_dataset = os.path.join(base_path, '../dataset/product_dataset.csv')
-        self.purchase_dataset = os.path.join(base_path, '../dataset/purchase_dataset.csv')
-        self.cookie_dataset = os.path.join(base_path, '../dataset/cookie_rating_dataset.csv')
+        # Datasets are stored by DatasetStore, see dataset_paths for their files
+        self.rating_dataset = 'rating_dataset'
+        self.product_dataset = 'product_dataset'
+        self.purchase_dataset = 'purchase_dataset'
+        self.cookie_dataset = 'cookie_rating_dataset'
 
         self.productID_to_name = {}
         self.name_to_productID = {}
-    
-    def loadRatingData(self):
-        ratingsDataset = 0
-        self.productID_to_name = {}
-        self.name_to_productID = {}
-
-        reader = Reader(line_format='user item rating', sep=',', skip_lines=1)
-
-        ratingsDataset = Dataset.load_from_file(self.rating_dataset, reader=reader)
 
-        with open(self.product_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-                productReader = csv.reader(csvfile)
-                next(productReader)  #Skip header line
-                for row in productReader:
-                    productID = int(row[0])
-                    productName = row[1]
-                    self.productID_to_name[productID] = productName
-                    self.name_to_productID[productName] = productID
+    def getCatalog(self):
+        return ProductCatalog.from_datasets(load_dataset(self.product_dataset, ['productId', 'Active', 'Quantity']),
+                                            load_dataset(self.purchase_dataset))
+
+    def _loadSurpriseData(self, dataset):
+        ratings = load_dataset(dataset, ['userId', 'productId', 'rating'])
+        reader = Reader(rating_scale=(1, 5))
+        ratingsDataset = Dataset.load_from_df(ratings.iloc[:0], reader=reader)
+        # Filled from whole columns rather than load_from_df's row loop, raw ids
+        # stay strings as when surprise parsed the CSV
+        ratingsDataset.raw_ratings = list(zip(ratings['userId'].astype(str).tolist(),
+                                              ratings['productId'].astype(str).tolist(),
+                                              ratings['rating'].astype('float64').tolist(),
+                                              [None] * len(ratings)))
+
+        products = load_dataset(self.product_dataset, ['productId', 'productName'])
+        self.productID_to_name = dict(zip(products['productId'].tolist(), products['productName'].tolist()))
+        self.name_to_productID = dict(zip(products['productName'].tolist(), products['productId'].tolist()))
 
         return ratingsDataset
     
+    def loadRatingData(self):
+        return self._loadSurpriseData(self.rating_dataset)
+
+    def _userRatings(self, dataset, user):
+        ratings = load_dataset(dataset, ['userId', 'productId', 'rating'])
+        ratings = ratings[ratings['userId'] == user]
+        return list(zip(ratings['productId'].tolist(), ratings['rating'].tolist()))
+    
     def getUserRatings(self, user):
-        userRatings = []
-        hitUser = False
-        with open(self.rating_dataset, newline='') as csvfile:
-            ratingReader = csv.reader(csvfile)
-            next(ratingReader)
-            for row in ratingReader:
-                userID = int(row[0])
-                if (user == userID):
-                    productID = int(row[1])
-                    rating = float(row[2])
-                    userRatings.append((productID, rating))
-                    hitUser = True
-                if (hitUser and (user != userID)):
-                    break
-
-        return userRatings
+        return self._userRatings(self.rating_dataset, user)
 
-    def getPopularityRanks(self):
-        ratings = defaultdict(int)
+    def _popularityRanks(self, dataset):
+        productIDs = load_dataset(dataset, ['productId'])['productId'].to_numpy()
+        ids, first, counts = np.unique(productIDs, return_index=True, return_counts=True)
+        # Most rated first, ties in order of first appearance
+        order = np.lexsort((first, -counts))
         rankings = defaultdict(int)
-        with open(self.rating_dataset, newline='') as csvfile:
-            ratingReader = csv.reader(csvfile)
-            next(ratingReader)
-            for row in ratingReader:
-                try:
-                    productID = int(float(row[1]))  # Convert to float first, then to int
-                    ratings[productID] += 1
-                except ValueError:
-                    print(f"Skipping row with invalid productID: {row[1]}")
-        rank = 1
-        for productID, ratingCount in sorted(ratings.items(), key=lambda x: x[1], reverse=True):
+        for rank, productID in enumerate(ids[order].tolist(), start=1):
             rankings[productID] = rank
-            rank += 1
         return rankings
+
+    def getPopularityRanks(self):
+        return self._popularityRanks(self.rating_dataset)
     
+    def _productTags(self):
+        products = load_dataset(self.product_dataset, ['productId', 'tag'])
+        return zip(products['productId'].tolist(), products['tag'].tolist())
+
     def getTags(self):
         tags = defaultdict(list)
         tagIDs = {}
         maxtagID = 0
-        with open(self.product_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-            productReader = csv.reader(csvfile)
-            next(productReader)  #Skip header line
-            for row in productReader:
-                productID = int(row[0])
-                tagList = row[2].split('|')
-                tagIDList = []
-                for tag in tagList:
-                    if tag in tagIDs:
-                        tagID = tagIDs[tag]
-                    else:
-                        tagID = maxtagID
-                        tagIDs[tag] = tagID
-                        maxtagID += 1
-                    tagIDList.append(tagID)
-                tags[productID] = tagIDList
+        for productID, tagString in self._productTags():
+            tagList = tagString.split('|')
+            tagIDList = []
+            for tag in tagList:
+                if tag in tagIDs:
+                    tagID = tagIDs[tag]
+                else:
+                    tagID = maxtagID
+                    tagIDs[tag] = tagID
+                    maxtagID += 1
+                tagIDList.append(tagID)
+            tags[productID] = tagIDList
         # Convert integer-encoded tag lists to bitfields that we can treat as vectors
         for (productID, tagIDList) in tags.items():
             bitfield = [0] * maxtagID
@@ -104,6 +192,23 @@ class ProductInfo:
             tags[productID] = bitfield            
         
         return tags
+
+    def getTagMatrix(self):
+        """Return a productID -> row dict and a sparse binary product x tag matrix."""
+        productTags = {}
+        tagIDs = {}
+        for productID, tagString in self._productTags():
+            # Same encoding as getTags, untagged products share the empty tag
+            productTags[productID] = {tagIDs.setdefault(tag, len(tagIDs)) for tag in tagString.split('|')}
+
+        productRows = {productID: row for row, productID in enumerate(productTags)}
+        indptr = np.zeros(len(productTags) + 1, dtype=np.int64)
+        np.cumsum([len(tagIDList) for tagIDList in productTags.values()], out=indptr[1:])
+        indices = np.fromiter((tagID for tagIDList in productTags.values() for tagID in sorted(tagIDList)),
+                              dtype=np.int64, count=indptr[-1])
+        data = np.ones(len(indices), dtype=np.float64)
+        tagMatrix = sparse.csr_matrix((data, indices, indptr), shape=(len(productTags), len(tagIDs)))
+        return productRows, tagMatrix
     
     def getProductName(self, productID):
         if productID in self.productID_to_name:
@@ -118,106 +223,30 @@ class ProductInfo:
             return 0
         
     def getAllProductIDs(self):
-        # Get all product ids from the first column of product_dataset csv file
-        product_ids = []
-        with open(self.product_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-            productReader = csv.reader(csvfile)
-            next(productReader)  # Skip header line
-            for row in productReader:
-                productID = int(row[0])
-                product_ids.append(productID)
-        return product_ids
+        # Get all product ids of the product dataset
+        return load_dataset(self.product_dataset, ['productId'])['productId'].tolist()
     
     def getActiveProductIDs(self):
-        # Get active product ids from the first column of product_dataset csv file
-        product_ids = []
-        with open(self.product_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-            productReader = csv.reader(csvfile)
-            next(productReader)  # Skip header line
-            for row in productReader:
-                if row[3] == 'True':
-                    productID = int(row[0])
-                    product_ids.append(productID)
-        return product_ids
+        # Get active product ids of the product dataset
+        products = load_dataset(self.product_dataset, ['productId', 'Active'])
+        return products.loc[products['Active'], 'productId'].tolist()
     
     def getPurchasedItems(self, user_id):
-        # Get all purchased product from the purchase_dataset csv file (the file contains 2 columns: CustomerId ProductId)
-        purchased_items = []
-        with open(self.purchase_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-            purchaseReader = csv.reader(csvfile)
-            next(purchaseReader)  # Skip header line
-            for row in purchaseReader:
-                customerID = int(row[0])
-                if customerID == user_id:
-                    productID = int(row[1])
-                    purchased_items.append(productID)
-        return purchased_items
+        # Get all purchased product of the customer from the purchase dataset (CustomerId, ProductId)
+        purchases = load_dataset(self.purchase_dataset)
+        return purchases.loc[purchases['CustomerId'] == user_id, 'ProductId'].tolist()
     
     def getInstockProductIDs(self):
-        # Get active product ids from the first column of product_dataset csv file
-        product_ids = []
-        with open(self.product_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-            productReader = csv.reader(csvfile)
-            next(productReader)  # Skip header line
-            for row in productReader:
-                if int(row[4]) > 0:
-                    productID = int(row[0])
-                    product_ids.append(productID)
-        return product_ids
+        # Get in-stock product ids of the product dataset
+        products = load_dataset(self.product_dataset, ['productId', 'Quantity'])
+        return products.loc[products['Quantity'] > 0, 'productId'].tolist()
 
 # Cookie User
     def loadCookieRatingData(self):
-        ratingsDataset = 0
-        self.productID_to_name = {}
-        self.name_to_productID = {}
-
-        reader = Reader(line_format='user item rating', sep=',', skip_lines=1)
-
-        ratingsDataset = Dataset.load_from_file(self.cookie_dataset, reader=reader)
-
-        with open(self.product_dataset, newline='', encoding='ISO-8859-1') as csvfile:
-                productReader = csv.reader(csvfile)
-                next(productReader)  #Skip header line
-                for row in productReader:
-                    productID = int(row[0])
-                    productName = row[1]
-                    self.productID_to_name[productID] = productName
-                    self.name_to_productID[productName] = productID
-
-        return ratingsDataset
+        return self._loadSurpriseData(self.cookie_dataset)
     
     def getCookieRatings(self, user):
-        userRatings = []
-        hitUser = False
-        with open(self.cookie_dataset, newline='') as csvfile:
-            ratingReader = csv.reader(csvfile)
-            next(ratingReader)
-            for row in ratingReader:
-                userID = int(row[0])
-                if (user == userID):
-                    productID = int(row[1])
-                    rating = float(row[2])
-                    userRatings.append((productID, rating))
-                    hitUser = True
-                if (hitUser and (user != userID)):
-                    break
-
-        return userRatings
+        return self._userRatings(self.cookie_dataset, user)
 
     def getCookiePopularityRanks(self):
-        ratings = defaultdict(int)
-        rankings = defaultdict(int)
-        with open(self.cookie_dataset, newline='') as csvfile:
-            ratingReader = csv.reader(csvfile)
-            next(ratingReader)
-            for row in ratingReader:
-                try:
-                    productID = int(float(row[1]))  # Convert to float first, then to int
-                    ratings[productID] += 1
-                except ValueError:
-                    print(f"Skipping row with invalid productID: {row[1]}")
-        rank = 1
-        for productID, ratingCount in sorted(ratings.items(), key=lambda x: x[1], reverse=True):
-            rankings[productID] = rank
-            rank += 1
-        return rankings
+        return self._popularityRanks(self.cookie_dataset)
@@ -0,0 +1,39 @@
+import numpy as np
+
+def top_n_indices(scores, n):
+    """Indices of the n highest scores, best first.
+
+    Equal scores keep their original order, exactly like a stable
+    ``sort(reverse=True)`` or ``heapq.nlargest``, but only the candidates
+    found by ``argpartition`` are sorted.
+    """
+    scores = np.asarray(scores)
+    if n <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if n >= len(scores):
+        return np.argsort(-scores, kind='stable')
+
+    # Keep every item tied with the n-th best so ties are broken by position
+    threshold = scores[np.argpartition(-scores, n - 1)[n - 1]]
+    candidates = np.flatnonzero(scores >= threshold)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:n]]
+
+def top_n_rows(scores, n):
+    """Row-wise ``top_n_indices`` of a 2-D array, returned as an (n_rows, n) array."""
+    scores = np.asarray(scores)
+    n = min(n, scores.shape[1])
+    if n <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.lexsort((top, -top_scores), axis=-1)
+    top = np.take_along_axis(top, order, axis=1)
+
+    # Rows with ties across the n-th position fall back to the exact tie-breaking
+    threshold = top_scores.min(axis=1)
+    ties = np.flatnonzero((scores >= threshold[:, None]).sum(axis=1) > n)
+    for row in ties:
+        top[row] = top_n_indices(scores[row], n)
+    return top
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import threading
+import time
+
+class ResultCache:
+    """Bounded LRU cache with a time-to-live for endpoint results.
+
+    ``version`` is an optional callable returning the state the results
+    depend on (e.g. ``ModelRegistry.version``); entries stored under another
+    version are treated as misses, so a retrain or refresh done by any worker
+    process invalidates them. It is called on every lookup and must be cheap:
+    ``ModelRegistry.version`` only stats the files once per second.
+    """
+
+    def __init__(self, maxsize=10000, ttl=600, version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._version = version or (lambda: None)
+        self._data = OrderedDict()  # key -> (expires, version, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (found, value)."""
+        version = self._version()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic() and entry[1] == version:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        version = self._version()
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
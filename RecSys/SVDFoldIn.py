@@ -0,0 +1,92 @@
+"""Fold-in of customers into a trained SVD model.
+
+A customer's bias and factors are fitted to their current ratings against the
+frozen item factors ``qi`` / ``bi``, by solving the regularized least squares
+that SGD training minimizes for that customer alone:
+
+    sum_i (r_ui - mu - bi - bu - qi . pu)^2 + n_u * (reg_bu * bu^2 + reg_pu * |pu|^2)
+
+New customers, and customers with ratings newer than the model, then get
+personalized scores until the next retrain picks their ratings up.
+"""
+
+from RecSys.DatasetStore import load_dataset
+import numpy as np
+
+class RatingIndex:
+    """Current ratings of the refreshed rating dataset, CSR by customer."""
+
+    def __init__(self, user_ids, indptr, product_ids, ratings):
+        self.user_ids = user_ids            # int64, sorted
+        self.indptr = indptr
+        self.product_ids = product_ids      # ratings of user_ids[k] are at indptr[k]:indptr[k+1]
+        self.ratings = ratings
+
+    @classmethod
+    def from_dataset(cls, ratings=None):
+        if ratings is None:
+            ratings = load_dataset('rating_dataset')
+        users = ratings['userId'].to_numpy(dtype=np.int64)
+        order = np.argsort(users, kind='stable')
+        user_ids, counts = np.unique(users[order], return_counts=True)
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(user_ids, indptr, ratings['productId'].to_numpy(dtype=np.int64)[order],
+                   ratings['rating'].to_numpy(dtype=np.float64)[order])
+
+    def ratings_of(self, user_id):
+        """Product ids and ratings of the customer, empty if they have none."""
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            # Cookie ids are never in the customer ratings
+            return self.product_ids[:0], self.ratings[:0]
+        k = np.searchsorted(self.user_ids, user_id)
+        if k == len(self.user_ids) or self.user_ids[k] != user_id:
+            return self.product_ids[:0], self.ratings[:0]
+        start, end = self.indptr[k], self.indptr[k + 1]
+        return self.product_ids[start:end], self.ratings[start:end]
+
+def fold_in(model, inner_items, ratings):
+    """Bias and factors (bu, pu) of a customer with the given ratings of trainset items."""
+    qi = np.asarray(model.qi[inner_items], dtype=np.float64)
+    n_ratings = len(inner_items)
+    if model.biased:
+        # bu is one more unknown, with a column of ones
+        design = np.hstack([np.ones((n_ratings, 1)), qi])
+        target = ratings - model.trainset.global_mean - model.bi[inner_items]
+        penalty = np.full(design.shape[1], model.reg_pu * n_ratings)
+        penalty[0] = model.reg_bu * n_ratings
+    else:
+        design, target = qi, np.asarray(ratings, dtype=np.float64)
+        penalty = np.full(design.shape[1], model.reg_pu * n_ratings)
+
+    solution = np.linalg.solve(design.T @ design + np.diag(penalty), design.T @ target)
+    if model.biased:
+        return solution[0], solution[1:]
+    return 0.0, solution
+
+def fresh_ratings(model, user_id, rating_index, catalog):
+    """Ratings of trainset items to fold the customer in from, None if the trained factors are up to date.
+
+    Customers are folded in when the model has never seen them, or when they
+    rated items since it was fit. Ratings of items the model does not know
+    cannot be used, they have no factors.
+    """
+    product_ids, ratings = rating_index.ratings_of(user_id)
+    rows = catalog.rows_of(product_ids)
+    inner_items = np.full(len(rows), -1, dtype=np.int64)
+    inner_items[rows >= 0] = catalog.inner_item_ids(model.trainset)[rows[rows >= 0]]
+    known = inner_items >= 0
+    inner_items, ratings = inner_items[known], ratings[known]
+    if len(inner_items) == 0:
+        return None
+
+    try:
+        u = model.trainset.to_inner_uid(str(user_id))
+    except ValueError:
+        return inner_items, ratings
+    trained_items = [i for i, _ in model.trainset.ur[u]]
+    if np.isin(inner_items, trained_items).all():
+        return None
+    return inner_items, ratings
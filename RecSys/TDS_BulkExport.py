@@ -0,0 +1,127 @@
+"""Score every user of a trained model, or a given list of ids, into Parquet files.
+
+    python -m RecSys.TDS_BulkExport svd exports/svd
+    python -m RecSys.TDS_BulkExport cookie_knn exports/cookies --user-ids cookies.txt --resume
+
+Users are split into chunks scored by a pool of processes, each loading the
+memory-mapped model and the catalog once. Every chunk is written as its own
+``part-<k>.parquet`` in the output directory with one row per
+recommendation (userId, rank, productId), so memory stays bounded by the
+chunk size and ``pd.read_parquet(directory)`` reads the whole export.
+With ``--resume`` the chunks already written by an interrupted export of the
+same model version and ids are skipped.
+"""
+
+from RecSys import TDS_GetRecs
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+# Users per part file, and per matrix product within a chunk
+CHUNK_SIZE = 10000
+SCORE_BLOCK_SIZE = 256
+
+MANIFEST = '_manifest.json'
+
+def read_user_ids(path, model_name):
+    """One id per line, of the user id type of the model."""
+    with open(path) as ids_file:
+        lines = [line.strip() for line in ids_file]
+    return TDS_GetRecs.coerce_user_ids(model_name, [line for line in lines if line])
+
+def part_path(output_dir, chunk):
+    return os.path.join(output_dir, f'part-{chunk:05d}.parquet')
+
+def _export_chunk(path, model_name, user_ids, n):
+    # Every worker loads the memory-mapped model and the catalog once, through its registry
+    model, catalog = TDS_GetRecs.registry.get(model_name), TDS_GetRecs.registry.get('catalog')
+    recommendations = []
+    for start in range(0, len(user_ids), SCORE_BLOCK_SIZE):
+        recommendations.extend(TDS_GetRecs.get_top_n_recommendations_batch(
+            user_ids[start:start + SCORE_BLOCK_SIZE], model, catalog, n=n))
+
+    lengths = [len(items) for items in recommendations]
+    part = pd.DataFrame({
+        'userId': np.repeat(np.array(user_ids), lengths),
+        'rank': np.concatenate([np.arange(1, length + 1) for length in lengths] + [np.zeros(0, dtype=np.int64)])
+                  .astype(np.int32),
+        'productId': np.array([item for items in recommendations for item in items], dtype=np.int32),
+    })
+    tmp_path = path + '.tmp'
+    part.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return len(user_ids)
+
+def export_recommendations(model_name, output_dir, user_ids=None, n=10, workers=None, chunk_size=CHUNK_SIZE,
+                           resume=False):
+    """Write the top n recommendations of every user (of the model if user_ids is None) to output_dir."""
+    model = TDS_GetRecs.load_model(TDS_GetRecs.MODEL_PATHS[model_name])
+    if user_ids is None:
+        user_ids = TDS_GetRecs.model_user_ids(model_name, model)
+    chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+
+    # A resumed export must score the same ids in the same chunks with the same model
+    manifest = {
+        'model': model_name,
+        'model_version': getattr(model, 'artifact_version', None),
+        'n': n,
+        'chunk_size': chunk_size,
+        'n_users': len(user_ids),
+        'user_ids_sha1': hashlib.sha1('\n'.join(map(str, user_ids)).encode()).hexdigest(),
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            previous = json.load(manifest_file)
+        if previous != manifest:
+            raise ValueError(f'{output_dir} holds an export of other ids or another model version, '
+                             'export again without resume')
+    else:
+        for name in os.listdir(output_dir):
+            if name.startswith('part-'):
+                os.remove(os.path.join(output_dir, name))
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    pending = [k for k in range(len(chunks)) if not os.path.exists(part_path(output_dir, k))]
+    total = sum(len(chunks[k]) for k in pending)
+    print(f"Exporting {model_name} recommendations of {total} users "
+          f"({len(user_ids) - total} already exported) to {output_dir}...")
+
+    start_time = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_export_chunk, part_path(output_dir, k), model_name, chunks[k], n)
+                   for k in pending]
+        for future in as_completed(futures):
+            done += future.result()
+            elapsed = time.perf_counter() - start_time
+            print(f"{done}/{total} users, {done / elapsed:.0f} users/s")
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{done} users exported in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} users/s).")
+    return done
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score users into Parquet files of top-N recommendations.')
+    parser.add_argument('model', choices=list(TDS_GetRecs.MODEL_PATHS))
+    parser.add_argument('output_dir')
+    parser.add_argument('--user-ids', help='file of ids to score, one per line (default: every user of the model)')
+    parser.add_argument('-n', type=int, default=10, help='recommendations per user')
+    parser.add_argument('--workers', type=int, default=None, help='scoring processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='users per part file')
+    parser.add_argument('--resume', action='store_true', help='skip the part files already written')
+    args = parser.parse_args(argv)
+
+    user_ids = read_user_ids(args.user_ids, args.model) if args.user_ids else None
+    export_recommendations(args.model, args.output_dir, user_ids=user_ids, n=args.n, workers=args.workers,
+                           chunk_size=args.chunk_size, resume=args.resume)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,28 @@
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler, RobustScaler
+import numpy as np
+from sklearn.preprocessing import MinMaxScaler
+from datetime import date
+from sqlalchemy import text
+import json
 import os
 import queries
+from RecSys.CoPurchase import CoPurchaseIndex
+from RecSys.PopularityRanking import PopularityRanking
+from RecSys.JobRunner import NULL_REPORTER
+from RecSys.DatasetStore import cast_dataset, dataset_path, save_dataset
 
-def robust_minmax(column_2d, minmax_range=(0,1)):
-        robust_scaler = RobustScaler()
-        robust_recency = robust_scaler.fit_transform(column_2d)
+# Rows fetched per round trip by the streaming extraction, None reads whole results
+REFRESH_CHUNK_SIZE = 100000
 
-        minmax_scaler = MinMaxScaler(feature_range=minmax_range)
-        scaled_column = minmax_scaler.fit_transform(robust_recency)
-        
-        return scaled_column
+# Partial aggregates are merged once they hold at least that many rows
+MERGE_MIN_ROWS = 100000
+
+# Date column of every event source of the preference queries, the incremental
+# refresh keeps one watermark per source
+PREFERENCE_SOURCES = {
+    'facebook': 'facebooklog.DateInserted',
+    'orders': 'item.CreateTime',
+}
 
 def get_iqr(column):
     q1 = column.quantile(0.25)
@@ -18,26 +30,167 @@ def get_iqr(column):
     iqr = q3 - q1
     return q1, q3, iqr
 
-def getRawData(cnxn):
+def read_sql_chunks(sql_query, cnxn, chunksize=REFRESH_CHUNK_SIZE, params=None):
+    """Yield the query result in DataFrames of up to chunksize rows, all at once if chunksize is None.
+
+    Values are bound as params (``:name`` in the query), never formatted into it."""
+    if chunksize is None:
+        yield pd.read_sql(text(sql_query), cnxn, params=params)
+        return
+    # pyodbc cursors fetch lazily, only one chunk of rows is held at a time
+    yield from pd.read_sql(text(sql_query), cnxn, params=params, chunksize=chunksize)
+
+def sum_by_keys(chunks, keys, columns):
+    """Per-key sums of the columns over every chunk.
+
+    Partial sums are merged whenever they outgrow the merged result, so
+    memory stays proportional to the number of distinct keys.
+    """
+    merged, parts, part_rows = [], [], 0
+    for chunk in chunks:
+        part = chunk.groupby(keys, sort=False)[columns].sum()
+        parts.append(part)
+        part_rows += len(part)
+        if part_rows > max(sum(len(m) for m in merged), MERGE_MIN_ROWS):
+            merged = [pd.concat(merged + parts).groupby(level=keys, sort=False).sum()]
+            parts, part_rows = [], 0
+    if not merged and not parts:
+        return pd.DataFrame(columns=keys + columns)
+    return pd.concat(merged + parts).groupby(level=keys).sum().reset_index()
+
+PREFERENCE_COLUMNS = ['preference_score', 'recency_weight', 'weighted_recency']
+
+def fold_preference(chunks, keys, sums=None, recency_range=None):
+    """Fold streamed events into per-key preference sums, on top of earlier sums.
+
+    Recency used to be scaled with robust_minmax before the groupby. The
+    robust scaler's shift and scale cancel out in the min-max scaling, so
+    recency_scaled is (recency - rmin) / (rmax - rmin) and the per-key sum of
+    preference_score * recency_scaled is (S1 - rmin * W) / (rmax - rmin), with
+    S1 the sum of preference_score * recency and W the sum of preference_score
+    over events with a recency. Only those sums and the recency range are kept
+    while reading, see scale_preference.
+
+    Returns the (sums, recency_range) pair.
+    """
+    recency_range = list(recency_range or [float('inf'), float('-inf')])
+
+    def weighted(chunks):
+        if sums is not None:
+            yield sums
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            recency_range[0] = min(recency_range[0], chunk['recency'].min())
+            recency_range[1] = max(recency_range[1], chunk['recency'].max())
+            # Events without a recency count for preference_score only, as NaN scaled scores did
+            chunk['recency_weight'] = chunk['preference_score'].where(chunk['recency'].notna(), 0)
+            chunk['weighted_recency'] = chunk['recency_weight'] * chunk['recency'].fillna(0)
+            yield chunk
+
+    return sum_by_keys(weighted(chunks), keys, PREFERENCE_COLUMNS), recency_range
+
+def scale_preference(sums, recency_range, keys):
+    """Per-key preference_score and scaled_preference_score from folded sums."""
+    rmin, rmax = recency_range
+    # MinMaxScaler maps a constant column to 0
+    span = rmax - rmin if rmax > rmin else 1
+    sums = sums.copy()
+    sums['scaled_preference_score'] = (sums['weighted_recency'] - rmin * sums['recency_weight']) / span
+    return sums[keys + ['preference_score', 'scaled_preference_score']]
+
+def sql_window(column, name, start, end):
+    """SQL condition on column for the days in [start, end), None leaves a side open.
+
+    Returns the condition and its parameters, bound as :<name>_start and
+    :<name>_end, so the query text only depends on which sides are open."""
+    if start is None:
+        # Undated events belong to the first window, as with a full refresh
+        return f"({column} < :{name}_end OR {column} IS NULL)", {f'{name}_end': end}
+    if end is None:
+        return f"{column} >= :{name}_start", {f'{name}_start': start}
+    return f"{column} >= :{name}_start AND {column} < :{name}_end", {f'{name}_start': start, f'{name}_end': end}
+
+def load_preference_state(name):
+    """Stored per-key sums and watermarks of an incremental extraction, None if there are none."""
+    path = dataset_path(name + '_state', 'npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as arrays:
+        meta = json.loads(str(arrays['meta']))
+        sums = pd.DataFrame({column: arrays[column] for column in meta['keys'] + PREFERENCE_COLUMNS})
+    return {
+        'anchor': date.fromisoformat(meta['anchor']),
+        'watermarks': {source: date.fromisoformat(day) for source, day in meta['watermarks'].items()},
+        'recency_range': meta['recency_range'],
+        'sums': sums,
+    }
+
+def save_preference_state(name, keys, state):
+    meta = {
+        'keys': keys,
+        'anchor': state['anchor'].isoformat(),
+        'watermarks': {source: day.isoformat() for source, day in state['watermarks'].items()},
+        'recency_range': [float(bound) for bound in state['recency_range']],
+    }
+    arrays = {column: state['sums'][column].to_numpy(dtype=np.int64 if column in keys else np.float64)
+              for column in keys + PREFERENCE_COLUMNS}
+
+    path = dataset_path(name + '_state', 'npz')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as state_file:
+        np.savez(state_file, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, path)
+
+def extract_preference(cnxn, sql_query, keys, name, incremental=False, chunksize=REFRESH_CHUNK_SIZE):
+    """Per-key preference sums of the events of every source, see fold_preference.
+
+    Recency is counted in days before a fixed anchor date instead of
+    GETDATE(). Min-max scaling ignores that shift, so the sums stored for
+    the days before the per-source watermarks stay valid on later days,
+    and an incremental refresh only reads the events since the watermarks.
+    Days before today are stored. Today's events may still grow, so they are
+    read again by the next refresh and only go into this dataset.
+
+    Events are never updated once their day is stored. Order status changes
+    and deleted events are picked up by the next full refresh.
+    """
+    today = date.today()
+    state = load_preference_state(name) if incremental else None
+    if state is None:
+        state = {'anchor': today, 'watermarks': dict.fromkeys(PREFERENCE_SOURCES), 'recency_range': None,
+                 'sums': None}
+    else:
+        print(f"Reading events since {min(state['watermarks'].values())}...")
+
+    def events(start_of, end):
+        windows, params = {}, {'anchor': state['anchor']}
+        for source, column in PREFERENCE_SOURCES.items():
+            windows[f'{source}_window'], window_params = sql_window(column, source, start_of(source), end)
+            params.update(window_params)
+        return read_sql_chunks(sql_query.format(**windows), cnxn, chunksize, params)
+
+    # Complete days since the watermarks
+    sums, recency_range = fold_preference(events(state['watermarks'].get, today), keys,
+                                          state['sums'], state['recency_range'])
+    save_preference_state(name, keys, {'anchor': state['anchor'], 'watermarks': dict.fromkeys(PREFERENCE_SOURCES, today),
+                                       'recency_range': recency_range, 'sums': sums})
+
+    # Today's events so far
+    sums, recency_range = fold_preference(events(lambda source: today, None), keys, sums, recency_range)
+    return scale_preference(sums, recency_range, keys)
+
+def getRawData(cnxn, chunksize=REFRESH_CHUNK_SIZE, incremental=False):
     ### Get dataset
     print("\nGet users' preference data...")
     sql_query = queries.recsys_dataset_refresh
-    rating_df = pd.read_sql(sql_query, cnxn)
+    # Events are deduplicated by the query, one per customer, product, action and day
 
-    rating_df.drop_duplicates(subset=['CustomerId', 'ProductId', 'action_type', 'recency'], keep='first', inplace=True)
     ### Transform rating dataset
 
-    # Reverese 'Recency'
-    rating_df['recency_inverse'] = rating_df.recency.max() - rating_df.recency
-
-    # Scale 'Recency'
-    rating_df['recency_scaled'] = robust_minmax(rating_df[['recency']])
-
-    # Multiple scaled recency with preference score
-    rating_df['scaled_preference_score'] = rating_df['preference_score'] * rating_df['recency_scaled']
-
-    # Sum the preference score by customer and product
-    rating_df_preprocessed = rating_df.groupby(['CustomerId', 'ProductId'], as_index=False)[['preference_score','scaled_preference_score']].sum()
+    # Sum the recency-scaled preference score by customer and product
+    rating_df_preprocessed = extract_preference(cnxn, sql_query, ['CustomerId', 'ProductId'], 'rating_dataset',
+                                                incremental, chunksize)
 
     # Drop outliers
     q1, q3, iqr = get_iqr(rating_df_preprocessed.scaled_preference_score)
@@ -55,29 +208,19 @@ def getRawData(cnxn):
     # Finalize the dataset
     rating_dataset = rating_df_preprocessed[['CustomerId', 'ProductId', 'likert_scaled_preference_score']]
     rating_dataset.columns = ['userId', 'productId', 'rating']
-    rating_dataset['userId'] = rating_dataset['userId'].apply(lambda x: str(x).split('.')[0])
-    rating_dataset['productId'] = rating_dataset['productId'].apply(lambda x: str(x).split('.')[0])
+    rating_dataset = rating_dataset.astype({'userId': 'int32', 'productId': 'int32'})
     return rating_dataset
 
-def getProductPreferenceData(cnxn):
+def getProductPreferenceData(cnxn, chunksize=REFRESH_CHUNK_SIZE, incremental=False):
     ### Get dataset
     print("Get product preference data...")
     sql_query = queries.recsys_product_preference
-    rating_df = pd.read_sql(sql_query, cnxn)
 
     ### Transform rating dataset
 
-    # Reverese 'Recency'
-    rating_df['recency_inverse'] = rating_df.recency.max() - rating_df.recency
-
-    # Scale 'Recency'
-    rating_df['recency_scaled'] = robust_minmax(rating_df[['recency']])
-
-    # Multiple scaled recency with preference score
-    rating_df['scaled_preference_score'] = rating_df['preference_score'] * rating_df['recency_scaled']
-
-    # Sum the preference score by customer and product
-    rating_df_preprocessed = rating_df.groupby(['ProductId', 'CategoryId'], as_index=False)[['preference_score','scaled_preference_score']].sum()
+    # Sum the recency-scaled preference score by product
+    rating_df_preprocessed = extract_preference(cnxn, sql_query, ['ProductId', 'CategoryId'],
+                                                'product_preference_dataset', incremental, chunksize)
 
     # Drop outliers
     q1, q3, iqr = get_iqr(rating_df_preprocessed.scaled_preference_score)
@@ -92,51 +235,83 @@ def getProductPreferenceData(cnxn):
     rating_dataset = rating_df_preprocessed[['ProductId', 'CategoryId', 'scaled_preference_score']]
     rating_dataset.columns = ['productId', 'categoryId', 'rating']
     rating_dataset.loc[:, 'productId'] = rating_dataset['productId'].astype(int)
-    rating_dataset.loc[:, 'CategoryId'] = rating_dataset['categoryId'].astype(int)
+    rating_dataset.loc[:, 'categoryId'] = rating_dataset['categoryId'].astype(int)
     return rating_dataset
 
 def getProductData(cnxn):
     print('Get product data...')
     sql_query = queries.recsys_product_dataset
-    product_dataset = pd.read_sql(sql_query, cnxn)
+    product_dataset = pd.read_sql(text(sql_query), cnxn)
     product_dataset['productId'] = product_dataset['productId'].astype(int)
     return product_dataset
 
-def getPurchaseData(cnxn):
+def getPurchaseData(cnxn, chunksize=REFRESH_CHUNK_SIZE):
     print('Get purchase data...')
     sql_query = queries.recsys_purchase_dataset
-    purchase_dataset = pd.read_sql(sql_query, cnxn)
-    purchase_dataset = purchase_dataset.astype(int)
-    return purchase_dataset
+    # Every chunk is cast to the stored int32 ids before the next one is read
+    purchase_dataset = pd.concat(cast_dataset(chunk.astype(int), 'purchase_dataset')
+                                 for chunk in read_sql_chunks(sql_query, cnxn, chunksize))
+    return purchase_dataset.reset_index(drop=True)
 
-def getCookieData(cnxn):
+def getCookieData(cnxn, chunksize=REFRESH_CHUNK_SIZE):
     print("Get cookie data...")
     sql_query = queries.recsys_cookie_dataset
-    rating_df = pd.read_sql(sql_query, cnxn)
-    rating_df.columns = ['userId', 'productId', 'rating']
-    rating_df['userId'] = rating_df['userId'].apply(lambda x: str(x).split("'")[0])
-    rating_df['productId'] = rating_df['productId'].apply(lambda x: str(x).split('.')[0])
-    return rating_df
-
-def main(cnxn):
+    chunks = []
+    for rating_df in read_sql_chunks(sql_query, cnxn, chunksize):
+        rating_df.columns = ['userId', 'productId', 'rating']
+        rating_df['userId'] = rating_df['userId'].astype(str).str.partition("'")[0]
+        rating_df['productId'] = rating_df['productId'].astype('int32')
+        rating_df['rating'] = rating_df['rating'].astype('float32')
+        chunks.append(rating_df)
+    # Categories are set once over every chunk, per-chunk categoricals would concat to strings
+    return cast_dataset(pd.concat(chunks).reset_index(drop=True), 'cookie_rating_dataset')
+
+def getBasketData(cnxn, chunksize=REFRESH_CHUNK_SIZE):
+    print('Get order basket data...')
+    sql_query = queries.recsys_basket_dataset
+    chunks = []
+    for basket_dataset in read_sql_chunks(sql_query, cnxn, chunksize):
+        basket_dataset['OrdersId'] = basket_dataset['OrdersId'].astype(int)
+        basket_dataset['ProductId'] = basket_dataset['ProductId'].astype(int)
+        chunks.append(cast_dataset(basket_dataset, 'basket_dataset'))
+    return pd.concat(chunks).reset_index(drop=True)
+
+def main(cnxn, reporter=NULL_REPORTER, export_csv=False, chunksize=REFRESH_CHUNK_SIZE, incremental=False):
+    """Extract every dataset as Parquet, export_csv also writes the old CSV files.
+
+    Query results are streamed in chunks of chunksize rows, None reads them whole.
+    With incremental set, the rating and product preference datasets only read
+    the events since the last refresh, see extract_preference."""
     
-    rating_dataset = getRawData(cnxn)
-    rating_dataset.to_csv('dataset/rating_dataset.csv', index=False)
+    with reporter.stage('rating_dataset'):
+        rating_dataset = getRawData(cnxn, chunksize, incremental)
+        save_dataset(rating_dataset, 'rating_dataset', csv=export_csv)
     print("Users' Preference data saved.")
 
-    product_dataset = getProductData(cnxn)
-    product_dataset.to_csv('dataset/product_dataset.csv', index=False)
+    with reporter.stage('product_dataset'):
+        product_dataset = save_dataset(getProductData(cnxn), 'product_dataset', csv=export_csv)
     print('Product data saved.')
 
-    purchase_dataset = getPurchaseData(cnxn)
-    purchase_dataset.to_csv('dataset/purchase_dataset.csv', index=False)
+    with reporter.stage('purchase_dataset'):
+        purchase_dataset = getPurchaseData(cnxn, chunksize)
+        save_dataset(purchase_dataset, 'purchase_dataset', csv=export_csv)
     print('Purchase data saved.')
 
-    purchase_dataset = getProductPreferenceData(cnxn)
-    purchase_dataset.to_csv('dataset/product_preference_dataset.csv', index=False)
+    with reporter.stage('product_preference_dataset'):
+        preference_dataset = save_dataset(getProductPreferenceData(cnxn, chunksize, incremental),
+                                          'product_preference_dataset', csv=export_csv)
+        # Favorite products per category, served by TDS_GetRecs.get_top_n_prefered_products
+        PopularityRanking.from_datasets(preference_dataset, product_dataset).save(
+            dataset_path('popularity_ranking', 'npz'))
     print('Product prefernce data saved.')
 
-    cookie_dataset = getCookieData(cnxn)
-    cookie_dataset.to_csv('dataset/cookie_rating_dataset.csv', index=False)
+    with reporter.stage('cookie_rating_dataset'):
+        cookie_dataset = getCookieData(cnxn, chunksize)
+        save_dataset(cookie_dataset, 'cookie_rating_dataset', csv=export_csv)
+
+    with reporter.stage('copurchase_index'):
+        basket_dataset = save_dataset(getBasketData(cnxn, chunksize), 'basket_dataset', csv=export_csv)
+        CoPurchaseIndex.from_baskets(basket_dataset).save(dataset_path('copurchase_index', 'npz'))
+    print('Co-purchase index saved.')
 
     print("\nDatasets refreshed!")
\ No newline at end of file
@@ -1,73 +1,382 @@
 import pickle
 from RecSys.ProductPreference import ProductInfo
+from RecSys.DatasetStore import dataset_path, dataset_paths, load_dataset
+from RecSys.ModelRegistry import ModelRegistry
+from RecSys import ModelArtifact
+from RecSys.ContentKNNAlgorithm import ContentKNNAlgorithm
+from RecSys.CoPurchase import CoPurchaseIndex
+from RecSys.CookieSessions import CookieSessionStore
+from RecSys.PopularityRanking import PopularityRanking
+from RecSys.SVDFoldIn import RatingIndex, fold_in, fresh_ratings
+from RecSys.ANNIndex import model_index, svd_query
+from RecSys.Ranking import top_n_indices, top_n_rows
+from surprise import SVD
 import os
-import pandas as pd
+import numpy as np
 
-def load_model(relative_path):
-    """Load the saved model from the given path."""
+MODEL_PATHS = {
+    'svd': '../app/svd_model',
+    'knn': '../app/content_knn_model',
+    'cookie_knn': '../app/cookie_content_knn_model',
+}
+
+# Models of anonymous visitors: their users are cookie ids (str), the others' customer ids (int)
+COOKIE_MODELS = ('cookie_knn',)
+
+def coerce_user_ids(model, raw_ids):
+    """User ids of the model from raw (str) ids, as the scoring and purchase filters expect them."""
+    if model in COOKIE_MODELS:
+        return [str(raw_id) for raw_id in raw_ids]
+    return [int(raw_id) for raw_id in raw_ids]
+
+def model_user_ids(model, model_file):
+    """Ids of every user known to the model, in raw id order."""
+    trainset = model_file.trainset
+    return coerce_user_ids(model, sorted(trainset.to_raw_uid(u) for u in range(trainset.n_users)))
+
+# Lists searched by the approximate nearest-neighbor indexes of the models, None
+# scores every item exactly. More lists give better recall for more latency,
+# see ANNBenchmark for the tradeoff. Indexes are only built by trainings run
+# with it set, models without one are scored exactly.
+ANN_PROBES = None
+
+def resolve_path(relative_path):
+    """Resolve a path relative to the module location."""
     base_path = os.path.dirname(os.path.abspath(__file__))
-    model_path = os.path.join(base_path, relative_path)
-    with open(model_path, 'rb') as model_file:
+    return os.path.join(base_path, relative_path)
+
+def load_model(relative_path):
+    """Load the saved model artifact, or the legacy pickle if there is no artifact yet."""
+    model_path = resolve_path(relative_path)
+    if os.path.exists(os.path.join(model_path, ModelArtifact.CURRENT)):
+        return ModelArtifact.load_artifact(model_path)
+    with open(model_path + '.pkl', 'rb') as model_file:
         model = pickle.load(model_file)
     return model
 
-def get_top_n_recommendations(user_id, model_file, ml, n=10):
-    """Get top N recommendations for the given user using the provided model."""
+# Models are loaded once per process and shared by every request
+registry = ModelRegistry()
+for model_name, model_path in MODEL_PATHS.items():
+    model_path = resolve_path(model_path)
+    registry.register(model_name, (os.path.join(model_path, ModelArtifact.CURRENT), model_path + '.pkl'),
+                      lambda paths, model_path=model_path: load_model(model_path))
 
-    active_items = ml.getActiveProductIDs() # Fetch the active items
-    instock_items = ml.getInstockProductIDs() # Fetch the instock items
-    item_ids = ml.getAllProductIDs()  # Adjust this method as needed to get all item IDs
-    purchased_items = ml.getPurchasedItems(user_id) # Fetch the items already purchased by the user
+# Top-N tables precomputed at retrain time, see TDS_RecSysTraining.precompute_recsys
+RECS_PATHS = {model_name: model_path + '_recs.npz' for model_name, model_path in MODEL_PATHS.items()}
 
-    
-    user_predictions = []
-    for item_id in item_ids:
-        # Exclude purchased, inactive and out-of-stock items
-        if item_id not in purchased_items and item_id in active_items and item_id in instock_items:  
-            prediction = model_file.predict(str(user_id), str(item_id))
-            user_predictions.append((item_id, prediction.est))
-    
-    # Sort predictions by estimated rating
-    user_predictions.sort(key=lambda x: x[1], reverse=True)
-    
-    return [item_id for item_id, _ in user_predictions[:n]]
+def load_recs_table(path):
+    with np.load(path) as table:
+        return {key: table[key] for key in table.files}
+
+for model_name, recs_path in RECS_PATHS.items():
+    registry.register('recs_' + model_name, resolve_path(recs_path), load_recs_table)
+
+# Product catalog is rebuilt whenever the refreshed datasets change
+_ml = ProductInfo()
+registry.register('catalog', dataset_paths(_ml.product_dataset) + dataset_paths(_ml.purchase_dataset),
+                  lambda paths: ProductInfo().getCatalog())
+
+# Frequently-bought-together index built by TDS_DataRefresh
+registry.register('copurchase', dataset_path('copurchase_index', 'npz'), CoPurchaseIndex.load)
+
+# Favorite products per category built by TDS_DataRefresh, ranked from the
+# preference dataset until the first refresh writes the ranking
+def load_popularity_ranking(paths):
+    if os.path.exists(paths[0]):
+        return PopularityRanking.load(paths[0])
+    preferences = load_dataset('product_preference_dataset', ['productId', 'categoryId', 'rating'])
+    return PopularityRanking.from_datasets(preferences, load_dataset('product_dataset', ['productId', 'Active', 'Quantity']))
+
+registry.register('popularity',
+                  (dataset_path('popularity_ranking', 'npz'),) + dataset_paths('product_preference_dataset'),
+                  load_popularity_ranking)
+
+# Current ratings, to fold customers newer than the SVD model in
+registry.register('ratings', dataset_paths('rating_dataset'), lambda paths: RatingIndex.from_dataset())
+
+def svd_fresh_ratings(user_id, model_file, catalog):
+    """Ratings to fold the user in from, None if the trained SVD factors are up to date."""
+    try:
+        rating_index = registry.get('ratings')
+    except FileNotFoundError:
+        return None
+    return fresh_ratings(model_file, user_id, rating_index, catalog)
+
+def svd_user_factors(user_id, model_file, catalog):
+    """Bias and factors (bu, pu) of the user, folded in if needed, None for the unknown parts."""
+    try:
+        u = model_file.trainset.to_inner_uid(str(user_id))
+        bu, pu = model_file.bu[u], model_file.pu[u]
+    except ValueError:
+        bu, pu = None, None
+    fresh = svd_fresh_ratings(user_id, model_file, catalog)
+    if fresh is not None:
+        bu, pu = fold_in(model_file, *fresh)
+    return bu, pu
+
+def score_svd(user_id, model_file, catalog, rows, factors=None):
+    """Estimate ratings of the catalog rows for one user in a single pass.
+
+    Same estimate as ``SVD.predict``: global mean + bu + bi + qi . pu for the
+    known parts, clipped to the rating scale. Users who are new or rated
+    items since the model was fit get bu and pu folded in from their current
+    ratings, see SVDFoldIn, unless ``factors`` already holds their
+    ``svd_user_factors``.
+    """
+    trainset = model_file.trainset
+    inner_items = catalog.inner_item_ids(trainset)[rows]
+    known_items = inner_items >= 0
+    item_ids = inner_items[known_items]
+    bu, pu = factors if factors is not None else svd_user_factors(user_id, model_file, catalog)
+
+    scores = np.full(len(rows), trainset.global_mean, dtype=np.float64)
+    if model_file.biased:
+        if bu is not None:
+            scores += bu
+        scores[known_items] += model_file.bi[item_ids]
+    if pu is not None:
+        # Unbiased SVD cannot predict for unknown items, they keep the global mean
+        dot = model_file.qi[item_ids] @ pu
+        if model_file.biased:
+            scores[known_items] += dot
+        else:
+            scores[known_items] = dot
+
+    lower_bound, higher_bound = trainset.rating_scale
+    return np.clip(scores, lower_bound, higher_bound)
+
+def score_svd_block(user_ids, model_file, catalog, rows):
+    """``score_svd`` for a block of users, one row of estimates per user.
+
+    The factors of the block are stacked and scored against the item
+    factors in a single matrix product.
+    """
+    trainset = model_file.trainset
+    inner_items = catalog.inner_item_ids(trainset)[rows]
+    known_items = inner_items >= 0
+    item_ids = inner_items[known_items]
+    n_factors = model_file.qi.shape[1]
+    factors = [svd_user_factors(user_id, model_file, catalog) for user_id in user_ids]
+    known_users = np.array([pu is not None for _, pu in factors], dtype=bool)
+    bu = np.array([0.0 if b is None else b for b, _ in factors])
+    pu = np.array([np.zeros(n_factors) if p is None else p for _, p in factors]).reshape(len(user_ids), n_factors)
+
+    scores = np.full((len(user_ids), len(rows)), trainset.global_mean, dtype=np.float64)
+    dot = pu @ model_file.qi[item_ids].T
+    if model_file.biased:
+        scores += bu[:, None]
+        scores[:, known_items] += model_file.bi[item_ids]
+        scores[:, known_items] += dot
+    else:
+        # Unknown users and items keep the global mean, as in score_svd
+        scores[np.ix_(known_users, known_items)] = dot[known_users]
+
+    lower_bound, higher_bound = trainset.rating_scale
+    return np.clip(scores, lower_bound, higher_bound)
+
+def svd_candidate_rows(pu, model_file, catalog, rows, n, n_probe):
+    """Rows holding the approximate best items of a user with factors pu, None to score every row."""
+    index = model_index(model_file)
+    if index is None:
+        return None
+    items = index.candidates(svd_query(model_file, pu), n_probe)
+    candidate_rows = rows[np.isin(rows, catalog.item_rows(model_file.trainset)[items])]
+    # Too few eligible candidates, e.g. the user bought most of them
+    if len(candidate_rows) < n:
+        return None
+    return candidate_rows
+
+# Views of anonymous visitors since the cookie model was fit, fed by /cookie_views
+cookie_sessions = CookieSessionStore()
+
+def live_session(model, user_id):
+    """Session profile of a cookie browsing right now, None for customers and cookies without one.
+
+    Only the cookie models read sessions: cookies and customer ids share no
+    namespace, a cookie named "5" is not customer 5.
+    """
+    if model not in COOKIE_MODELS:
+        return None
+    return cookie_sessions.profile(str(user_id))
+
+def session_ratings(u, model_file, catalog, product_ids, weights):
+    """Trained ratings of inner user u (if any) plus the decayed views of their session, by inner item id.
+
+    Session weights are recency-weighted view counts like the ratings of
+    cookie_rating_dataset, so views of a trained product add to its rating.
+    Products unknown to the model have no similarities and are left out.
+    """
+    trainset = model_file.trainset
+    ratings = dict(trainset.ur[u]) if u is not None else {}
+    rows = catalog.rows_of(product_ids)
+    inner_items = np.where(rows >= 0, catalog.inner_item_ids(trainset)[np.maximum(rows, 0)], -1)
+    for i, weight in zip(inner_items.tolist(), weights.tolist()):
+        if i >= 0:
+            ratings[i] = ratings.get(i, 0.0) + weight
+    return np.fromiter(ratings.keys(), dtype=np.int64), np.fromiter(ratings.values(), dtype=np.float64)
+
+def score_knn(user_id, model_file, catalog, rows, session=None):
+    """Estimate ratings of the catalog rows for one user with ContentKNNAlgorithm.estimate_batch.
+
+    Cookies with a live session (see live_session) are scored on their trained
+    ratings merged with their session profile, by the similarity
+    weighted sum of those ratings: a visitor with a single view would get
+    the same average for every item similar to it.
+    """
+    trainset = model_file.trainset
+    inner_items = catalog.inner_item_ids(trainset)[rows]
+    try:
+        u = trainset.to_inner_uid(str(user_id))
+    except ValueError:
+        u = None
+
+    if session is not None:
+        rated, ratings = session_ratings(u, model_file, catalog, *session)
+        scores = model_file.estimate_from_ratings(rated, ratings, inner_items, normalize=False)
+        # Items similar to nothing the visitor saw come last
+        scores[np.isnan(scores)] = 0
+        return scores
+
+    scores = model_file.estimate_batch(u, inner_items)
+    # Impossible predictions fall back to the global mean, as in predict
+    scores[np.isnan(scores)] = trainset.global_mean
+
+    lower_bound, higher_bound = trainset.rating_scale
+    return np.clip(scores, lower_bound, higher_bound)
+
+def score_items(user_id, model_file, catalog, rows, session=None):
+    """Estimated ratings of the catalog rows for one user, session only applies to KNN models."""
+    if isinstance(model_file, SVD):
+        return score_svd(user_id, model_file, catalog, rows)
+    if isinstance(model_file, ContentKNNAlgorithm):
+        return score_knn(user_id, model_file, catalog, rows, session)
+    return np.array([model_file.predict(str(user_id), str(item_id)).est
+                     for item_id in catalog.product_ids[rows].tolist()])
+
+def get_top_n_recommendations(user_id, model_file, catalog, n=10, n_probe=None, session=None):
+    """Get top N recommendations for the given user using the provided model.
+
+    With ``n_probe`` set, SVD models only score the candidates found by
+    their approximate index of the item factors. ``session`` is the live
+    session of a cookie, see live_session.
+    """
+
+    # Exclude purchased, inactive and out-of-stock items
+    rows = np.flatnonzero(catalog.eligible_mask(user_id))
+    if isinstance(model_file, SVD):
+        # Folded in once, for both the index query and the scores
+        factors = svd_user_factors(user_id, model_file, catalog)
+        if n_probe is not None:
+            candidate_rows = svd_candidate_rows(factors[1], model_file, catalog, rows, n, n_probe)
+            if candidate_rows is not None:
+                rows = candidate_rows
+        scores = score_svd(user_id, model_file, catalog, rows, factors)
+    else:
+        scores = score_items(user_id, model_file, catalog, rows, session)
+
+    # Best estimated ratings first, ties in catalog order
+    return catalog.product_ids[rows[top_n_indices(scores, n)]].tolist()
+
+def get_top_n_recommendations_batch(user_ids, model_file, catalog, n=10, sessions=None):
+    """``get_top_n_recommendations`` for a block of users, one list per user.
+
+    SVD models score the whole block with ``score_svd_block`` over every
+    available product, then each user's purchases are ranked out. Other
+    models score user by user, with the live sessions of the users if
+    given. Every item is scored exactly, whatever ANN_PROBES is.
+    """
+    if not isinstance(model_file, SVD):
+        sessions = sessions or [None] * len(user_ids)
+        return [get_top_n_recommendations(user_id, model_file, catalog, n, session=session)
+                for user_id, session in zip(user_ids, sessions)]
+
+    rows = np.flatnonzero(catalog.available)
+    scores = score_svd_block(user_ids, model_file, catalog, rows)
+    for k, user_id in enumerate(user_ids):
+        purchased = catalog.purchased_rows(user_id)
+        scores[k, np.searchsorted(rows, purchased[catalog.available[purchased]])] = -np.inf
+
+    # Best estimated ratings first, ties in catalog order
+    top = top_n_rows(scores, n)
+    return [catalog.product_ids[rows[picked[np.isfinite(user_scores[picked])]]].tolist()
+            for picked, user_scores in zip(top, scores)]
 
 def get_top_n_prefered_products(category, n=10):
-    ml = ProductInfo()
-    pro_preference = pd.read_csv('dataset/product_preference_dataset.csv')
-    active_items = ml.getActiveProductIDs() # Fetch the active items
-    instock_items = ml.getInstockProductIDs() # Fetch the instock items
-
-    sorted_pro_perference = pro_preference.sort_values('rating', ascending=False)
-    if category:
-        return sorted_pro_perference.loc[(pro_preference.categoryId == category) 
-                                                    & pro_preference.productId.isin(active_items)
-                                                    & pro_preference.productId.isin(instock_items),
-                                                    'productId'][:n].tolist()
-    
-    return sorted_pro_perference.loc[pro_preference.productId.isin(active_items)
-                                     & pro_preference.productId.isin(instock_items),
-                                     'productId'][:n].tolist()
+    """Favorite products of the category (of every category if None) that are active and in stock."""
+    return registry.get('popularity').top(registry.get('catalog'), category, n)
+
+def get_cross_sell_items(product_id, customer_id=None, n=10):
+    """Get frequently-bought-together items from the offline co-purchase index."""
+    return registry.get('copurchase').cross_sell(product_id, registry.get('catalog'), customer_id=customer_id, n=n)
+
+def lookup_recommendations(model, user_id, model_file, catalog, n=10):
+    """Get top N recommendations from the precomputed table, None if the user must be scored live."""
+    try:
+        table = registry.get('recs_' + model)
+    except FileNotFoundError:
+        return None
+
+    # Tables written for another version of the model are ignored
+    if str(table['model_version']) != getattr(model_file, 'artifact_version', None):
+        return None
+    # Users rated items since the table was written, their factors are folded in live
+    if isinstance(model_file, SVD) and svd_fresh_ratings(user_id, model_file, catalog) is not None:
+        return None
+    # Cookies browsing right now are scored with their session
+    if model in COOKIE_MODELS and cookie_sessions.version(str(user_id)):
+        return None
+
+    user_ids = table['user_ids']
+    k = np.searchsorted(user_ids, str(user_id))
+    if k == len(user_ids) or user_ids[k] != str(user_id):
+        return None
+
+    # Re-apply the active, in-stock and purchased filters as of now
+    items = table['items'][k]
+    rows = catalog.rows_of(items[items >= 0])
+    rows = rows[rows >= 0]
+    rows = rows[catalog.available[rows] & ~np.isin(rows, catalog.purchased_rows(user_id))]
+    if len(rows) < n:
+        return None
+    return catalog.product_ids[rows[:n]].tolist()
 
 def main(model, user_id=None, item_id=None):
-    # Load the model
-    print("Loading the model...")
-
-    if model == 'svd':
-        model_file = load_model('../app/svd_model.pkl')
-    elif model == 'knn':
-        model_file = load_model('../app/content_knn_model.pkl')
-    elif model == 'cookie_knn':
-        model_file = load_model('../app/cookie_content_knn_model.pkl')
-    else:
+    # Get the model from the in-memory registry
+    if model not in MODEL_PATHS:
         return 'Model name must be among: "svd", "knn", "cookie_knn"'
+    model_file = registry.get(model)
     
-    # Load product information
-    ml = ProductInfo()
+    # Product information is shared until the next dataset refresh
+    catalog = registry.get('catalog')
 
     if user_id:
-        top_recommendations = get_top_n_recommendations(user_id, model_file, ml, n=10)
+        top_recommendations = lookup_recommendations(model, user_id, model_file, catalog, n=10)
+        if top_recommendations is None:
+            top_recommendations = get_top_n_recommendations(user_id, model_file, catalog, n=10, n_probe=ANN_PROBES,
+                                                            session=live_session(model, user_id))
     if item_id:
-        top_recommendations = model_file.get_similar_items(item_id)
+        top_recommendations = model_file.get_similar_items(item_id, n_probe=ANN_PROBES)
+
+    return top_recommendations
+
+def main_batch(model, user_ids=None, item_ids=None, n=10):
+    """``main`` for a block of users or of items, one list of recommendations per id.
+
+    Model and catalog are fetched once for the block, and users missing from
+    the precomputed table are scored together. Items unknown to the model
+    get None.
+    """
+    model_file = registry.get(model)
+    catalog = registry.get('catalog')
+
+    if item_ids is not None:
+        return model_file.get_similar_items_batch(item_ids, n, n_probe=ANN_PROBES)
 
-    return top_recommendations
\ No newline at end of file
+    recommendations = [lookup_recommendations(model, user_id, model_file, catalog, n=n) for user_id in user_ids]
+    missing = [k for k, top in enumerate(recommendations) if top is None]
+    missing_ids = [user_ids[k] for k in missing]
+    scored = get_top_n_recommendations_batch(missing_ids, model_file, catalog, n=n,
+                                             sessions=[live_session(model, user_id) for user_id in missing_ids])
+    for k, top in zip(missing, scored):
+        recommendations[k] = top
+    return recommendations
@@ -1,8 +1,38 @@
 from RecSys.ProductPreference import ProductInfo
-from RecSys.ContentKNNAlgorithm import ContentKNNAlgorithm
+from RecSys.ContentKNNAlgorithm import ContentKNNAlgorithm, fit_content_models
+from RecSys.ALSAlgorithm import ALSAlgorithm
+from RecSys.ANNIndex import IVFIndex, attach_index, svd_item_vectors
+from RecSys import ModelArtifact
+from RecSys import TDS_GetRecs
+from RecSys.JobRunner import NULL_REPORTER
 from surprise import SVD
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import pickle, os
+import multiprocessing
+import threading
+import numpy as np
+import os
+
+# Number of neighbors kept per item by the content KNN models.
+# None keeps the dense n_items x n_items similarity matrix.
+KNN_NEIGHBORS = None
+
+# Trainers of the collaborative filtering model, both saved and served as the svd model.
+# 'als' solves the same model by alternating least squares on every core.
+COLLAB_ALGORITHMS = {
+    'svd': lambda progress: SVD(n_factors=50, n_epochs=30, lr_all= 0.01, reg_all= 0.05, random_state=1),
+    'als': lambda progress: ALSAlgorithm(n_factors=50, n_epochs=10, reg_all=0.05, random_state=1, progress=progress),
+}
+COLLAB_ALGORITHM = 'svd'
+
+# Number of recommendations stored per user by the precompute stage, more than
+# served so that items going inactive or out of stock can be filtered at read time
+PRECOMPUTE_DEPTH = 50
+
+# Training runs from a job thread of the multi-threaded app process, forking it could
+# hand the children locks held by other threads (logging, DB pool, BLAS), so worker
+# processes are started fresh
+MP_CONTEXT = multiprocessing.get_context('spawn')
 
 def load_data():
     print("Loading dataset...")
@@ -12,50 +42,155 @@ def load_data():
 
     return full_trainSet
 
+def load_cookie_data():
+    print("Loading cookie dataset...")
+    ml = ProductInfo()
+    data = ml.loadCookieRatingData()
+    full_trainSet = data.build_full_trainset()
+
+    return full_trainSet
+
 def save_model(relative_path, algorithm):
+    """Save the model as a memory-mappable artifact directory."""
     base_path = os.path.dirname(os.path.abspath(__file__))
     path = os.path.join(base_path, relative_path)
-    with open(path, 'wb') as model_file:
-        pickle.dump(algorithm, model_file)
+    ModelArtifact.save_artifact(path, algorithm)
 
-def collab_filter_recsys():
-    full_trainSet = load_data()
+def collab_filter_recsys(full_trainSet=None, progress=None, algorithm=COLLAB_ALGORITHM):
+    if full_trainSet is None:
+        full_trainSet = load_data()
 
     # SVD recommender
-    SVDAlgorithm = SVD(n_factors=50, n_epochs=30, lr_all= 0.01, reg_all= 0.05, random_state=1)
+    SVDAlgorithm = COLLAB_ALGORITHMS[algorithm](progress)
     SVDAlgorithm.fit(full_trainSet)
+    # Approximate index of the item factors, only built when TDS_GetRecs.ANN_PROBES serves from it
+    if TDS_GetRecs.ANN_PROBES is not None:
+        attach_index(SVDAlgorithm, IVFIndex.build(svd_item_vectors(SVDAlgorithm)))
 
-    save_model('../app/svd_model.pkl', SVDAlgorithm)
+    save_model('../app/svd_model', SVDAlgorithm)
     print("\nCollaborative Filtering model saved.")
 
-def content_filter_recsys():
-    full_trainSet = load_data()
+def content_filter_recsys(full_trainSet=None, cookie_trainSet=None, progress=None):
+    """Fit the customer and cookie content KNN models from one tag similarity computation."""
+    if full_trainSet is None:
+        full_trainSet = load_data()
+    if cookie_trainSet is None:
+        cookie_trainSet = load_cookie_data()
 
     # Content KNN Algorithm
-    algo = ContentKNNAlgorithm(k=20)
-    algo.fit(full_trainSet)
+    algo = ContentKNNAlgorithm(k=20, n_neighbors=KNN_NEIGHBORS)
+    cookie_algo = ContentKNNAlgorithm(k=20, n_neighbors=KNN_NEIGHBORS)
+    fit_content_models([(algo, full_trainSet), (cookie_algo, cookie_trainSet)],
+                       ProductInfo().getTagMatrix(), algo.block_size, progress,
+                       ann_index=TDS_GetRecs.ANN_PROBES is not None)
 
-    save_model('../app/content_knn_model.pkl', algo)
+    save_model('../app/content_knn_model', algo)
     print("\nContent-based Filtering model saved.")
+    save_model('../app/cookie_content_knn_model', cookie_algo)
+    print("\nContent-based Filtering model for cookie saved.")
 
-def cookie_content_filter_recsys():
-    print("Loading cookie dataset...")
-    ml = ProductInfo()
-    data = ml.loadCookieRatingData()
-    full_trainSet = data.build_full_trainset()
+def _precompute_chunk(model_name, user_ids, depth):
+    # Every worker loads the memory-mapped model and the catalog once, through its registry
+    model, catalog = TDS_GetRecs.registry.get(model_name), TDS_GetRecs.registry.get('catalog')
+    items = np.full((len(user_ids), depth), -1, dtype=np.int64)
+    for k, user_id in enumerate(user_ids):
+        top = TDS_GetRecs.get_top_n_recommendations(user_id, model, catalog, n=depth)
+        items[k, :len(top)] = top
+    return items
 
-    # Content KNN Algorithm
-    algo = ContentKNNAlgorithm(k=20)
-    algo.fit(full_trainSet)
+def precompute_recsys(model_name, depth=PRECOMPUTE_DEPTH, workers=None, chunk_size=500):
+    """Score every user known to the saved model and write its top-N table."""
+    print(f"Precomputing {model_name} recommendations...")
+    model = TDS_GetRecs.load_model(TDS_GetRecs.MODEL_PATHS[model_name])
+    trainset = model.trainset
+    raw_ids = sorted(trainset.to_raw_uid(u) for u in range(trainset.n_users))
+    # Customers are looked up by their integer id, cookies by their string id
+    user_ids = TDS_GetRecs.coerce_user_ids(model_name, raw_ids)
 
-    save_model('../app/cookie_content_knn_model.pkl', algo)
-    print("\nContent-based Filtering model for cookie saved.")
+    chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT) as executor:
+        results = list(executor.map(_precompute_chunk, [model_name] * len(chunks), chunks, [depth] * len(chunks)))
+    items = np.concatenate(results) if results else np.empty((0, depth), dtype=np.int64)
+
+    path = TDS_GetRecs.resolve_path(TDS_GetRecs.RECS_PATHS[model_name])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as table_file:
+        np.savez(table_file, user_ids=np.array(raw_ids, dtype=str), items=items,
+                 model_version=np.array(model.artifact_version))
+    os.replace(tmp_path, path)
+    print(f"{len(raw_ids)} users precomputed for {model_name}.")
+
+# Training stages, each fitted and saved in its own process. The content
+# stage fits both KNN models as they share one tag similarity computation.
+TRAINING_JOBS = {
+    'svd': collab_filter_recsys,
+    'content_knn': content_filter_recsys,
+}
+
+def _fit_model(name, trainsets, options, progress_queue):
+    def progress(done, total):
+        progress_queue.put((name, done, total))
+    TRAINING_JOBS[name](*trainsets, progress=progress, **options)
+
+def _forward_progress(progress_queue, reporter):
+    while True:
+        update = progress_queue.get()
+        if update is None:
+            return
+        name, done, total = update
+        reporter.progress(done, total, stage=name)
 
-def main():
-    collab_filter_recsys()
-    content_filter_recsys()
-    cookie_content_filter_recsys()
+def fit_models(reporter=NULL_REPORTER, collab_algorithm=COLLAB_ALGORITHM):
+    """Fit the models in parallel, wall-clock time is the one of the slowest model."""
+    # Every rating file is parsed once and its trainset shared by the models using it
+    with reporter.stage('load_data'):
+        full_trainSet = load_data()
+        cookie_trainSet = load_cookie_data()
+    trainsets = {
+        'svd': (full_trainSet,),
+        'content_knn': (full_trainSet, cookie_trainSet),
+    }
+    options = {
+        'svd': {'algorithm': collab_algorithm},
+        'content_knn': {},
+    }
+
+    with MP_CONTEXT.Manager() as manager:
+        progress_queue = manager.Queue()
+        forwarder = threading.Thread(target=_forward_progress, args=(progress_queue, reporter), daemon=True)
+        forwarder.start()
+
+        with ProcessPoolExecutor(max_workers=len(TRAINING_JOBS), mp_context=MP_CONTEXT) as executor:
+            futures = {}
+            for name in TRAINING_JOBS:
+                reporter.start_stage(name)
+                futures[executor.submit(_fit_model, name, trainsets[name], options[name], progress_queue)] = name
+
+            errors = []
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                    reporter.finish_stage(name)
+                except Exception as error:
+                    reporter.finish_stage(name, status='failed')
+                    errors.append(error)
+
+        progress_queue.put(None)
+        forwarder.join()
+
+    if errors:
+        raise errors[0]
+
+def main(precompute=False, reporter=NULL_REPORTER, collab_algorithm=COLLAB_ALGORITHM):
+    fit_models(reporter, collab_algorithm)
     print('\nRecsys models saved.')
 
+    if precompute:
+        for model_name in TDS_GetRecs.MODEL_PATHS:
+            with reporter.stage('precompute_' + model_name):
+                precompute_recsys(model_name)
+        print('\nRecommendation tables saved.')
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
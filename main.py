@@ -1,18 +1,25 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 
 import pandas as pd
-from pydantic import BaseModel
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from contextlib import contextmanager
+from pydantic import BaseModel, Field
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from contextlib import asynccontextmanager
+import json
+import os
 
 from RecSys import TDS_DataRefresh
 from RecSys import TDS_GetRecs
 from RecSys import TDS_RecSysTraining
+from RecSys.ResultCache import ResultCache
+from RecSys.BoundedExecutor import BoundedExecutor, ExecutorBusy
+from RecSys.JobRunner import JobRunner, JobRejected
+from RecSys.PoolMetrics import PoolMetrics
 import queries, server_info
 
-from typing import Optional
+from typing import Annotated, Optional
 
 ### Class settings
 class Customer(BaseModel):
@@ -21,6 +28,16 @@ class Customer(BaseModel):
 class Cookie(BaseModel):
     cookie: str
 
+# Bounds of a /cookie_views request: every view lands in the session store of the worker
+COOKIE_MAX_LENGTH = 128
+COOKIE_VIEWS_MAX = 1000
+COOKIE_VIEW_COUNT_MAX = 100
+
+class CookieView(BaseModel):
+    cookie: str = Field(min_length=1, max_length=COOKIE_MAX_LENGTH)
+    product_id: int = Field(ge=0)
+    view_count: int = Field(default=1, ge=1, le=COOKIE_VIEW_COUNT_MAX)
+
 class Product(BaseModel):
     product_id: int
 
@@ -31,13 +48,30 @@ class RSInput(BaseModel):
     product_id: int
     customer_id: Optional[int]
 
+class CustomerBatch(BaseModel):
+    customer_ids: list[int]
+
+class ProductBatch(BaseModel):
+    product_ids: list[int]
+
+class RSInputBatch(BaseModel):
+    inputs: list[RSInput]
+
 class customer_data(BaseModel):
     customer_id: list[int]
     height: list[int]
     weight: list[int]
 
 ### FastAPI app settings
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the models once per worker instead of on every request
+    TDS_GetRecs.registry.load_all()
+    yield
+    for executor in (scoring_executor, db_executor):
+        executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost",
     "http://localhost:8080",
@@ -57,91 +91,237 @@ DATABASE_URL = (
     "?driver=SQL+Server"
 )
 
-# Create SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+# Create SQLAlchemy engine, pool settings can be overridden by environment variables at startup
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))      # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))      # reopen connections older than that
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'   # test connections on checkout
+engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING)
+pool_metrics = PoolMetrics(engine)
+
+# Endpoint results are cached until they expire or a model/dataset file changes
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 600
+result_cache = ResultCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                           version=TDS_GetRecs.registry.version)
+
+# Blocking work runs on bounded thread pools so the event loop keeps serving:
+# scoring is CPU-bound and DB calls get one thread per pooled connection
+SCORING_WORKERS = os.cpu_count() or 1
+SCORING_MAX_PENDING = 8 * SCORING_WORKERS
+scoring_executor = BoundedExecutor(SCORING_WORKERS, SCORING_MAX_PENDING, 'scoring')
+db_executor = BoundedExecutor(DB_POOL_SIZE + DB_MAX_OVERFLOW, 4 * (DB_POOL_SIZE + DB_MAX_OVERFLOW), 'db')
+
+# Refresh and retrain run as background jobs, their state is shared by every worker
+JOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'jobs')
+job_runner = JobRunner(JOBS_DIR)
+
+@app.exception_handler(ExecutorBusy)
+async def executor_busy_handler(request: Request, exc: ExecutorBusy):
+    return JSONResponse(status_code=503, content={'detail': str(exc)}, headers={'Retry-After': '1'})
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(status_code=503, content={'detail': 'No database connection available, retry later'},
+                        headers={'Retry-After': '1'})
+
+@app.exception_handler(JobRejected)
+async def job_rejected_handler(request: Request, exc: JobRejected):
+    return JSONResponse(status_code=409, content={'detail': str(exc), 'job': exc.job})
+
+async def cached(key, executor, compute):
+    """Return the cached result for key, or compute it on the given executor."""
+    found, value = result_cache.get(key)
+    if not found:
+        value = await executor.run(compute)
+        result_cache.set(key, value)
+    return value
+
+# Ids computed per executor call by the batch endpoints
+BATCH_BLOCK_SIZE = 256
+
+async def ndjson_stream(ids, executor, compute_block):
+    """Stream compute_block(block) of every block of ids as NDJSON lines, one per id.
+
+    The first block runs before the response starts, so a busy executor
+    still answers 503. Later blocks wait for a free slot instead, a stream
+    cannot fail half-way, and hold at most one slot at a time.
+    """
+    blocks = [ids[start:start + BATCH_BLOCK_SIZE] for start in range(0, len(ids), BATCH_BLOCK_SIZE)]
+    first = await executor.run(compute_block, blocks[0]) if blocks else []
+
+    async def lines():
+        yield ''.join(json.dumps(result) + '\n' for result in first)
+        for block in blocks[1:]:
+            results = await executor.run(compute_block, block, wait=True)
+            yield ''.join(json.dumps(result) + '\n' for result in results)
 
-# Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
 
 pd.set_option('future.no_silent_downcasting', True)
 pd.options.mode.chained_assignment = None
 
-@contextmanager
 def get_cnxn():
-    """Return SQLAlchemy session with the default settings"""
-
-    print("\nConnect to database...")
-    session = SessionLocal()
-    try:
-        yield session
-    finally:
-        session.close()
+    """Return a pooled SQLAlchemy connection, the time waited for it goes to the pool metrics"""
+    return pool_metrics.connect()
 
 def query_sql(sql_query, cnxn, **kwargs):
-        """Return dataframe with the query, connection, and vars as args"""
+        """Return dataframe with the query, connection, and vars bound as its :name parameters"""
 
-        formatted_query = sql_query.format(**kwargs)
-        recs = pd.read_sql(formatted_query, cnxn)
+        recs = pd.read_sql(text(sql_query), cnxn, params=kwargs)
         return recs
 
 @app.get("/")
 async def home():
     return "RECOMMENDATION SYSTEM"
 
-# Refresh User Recommendation System datasets
+def refresh_data(export_csv, incremental, reporter):
+    with get_cnxn() as cnxn:
+        TDS_DataRefresh.main(cnxn, reporter=reporter, export_csv=export_csv, incremental=incremental)
+    TDS_GetRecs.registry.reload(['catalog', 'copurchase'])
+    result_cache.clear()
+
+def retrain_models(precompute, algorithm, reporter):
+    TDS_RecSysTraining.main(precompute=precompute, reporter=reporter, collab_algorithm=algorithm)
+    TDS_GetRecs.registry.reload()
+    result_cache.clear()
+
+# Refresh User Recommendation System datasets, returns the job to poll.
+# Incremental refreshes only read the preference events since the last refresh.
 @app.get("/refesh_recsys_data")
-async def refesh_recsys_data():
-    with get_cnxn() as session:
-        with session.connection() as cnxn:
-            TDS_DataRefresh.main(cnxn)
-    return "Recommendation System datasets refreshed!"
+async def refesh_recsys_data(export_csv: bool = False, incremental: bool = False):
+    return job_runner.submit('refresh', refresh_data, export_csv, incremental)
 
-# Re-train User Recommendation System model
+# Re-train User Recommendation System model, returns the job to poll.
+# The collaborative model is fitted by SGD ('svd') or by alternating least squares ('als').
 @app.get("/retrain_recsys_model")
-async def retrain_recsys_model():
-    TDS_RecSysTraining.main()
-    return "Recommendation System models retrained!"
+async def retrain_recsys_model(precompute: bool = False,
+                               algorithm: str = Query(TDS_RecSysTraining.COLLAB_ALGORITHM, enum=['svd', 'als'])):
+    return job_runner.submit('retrain', retrain_models, precompute, algorithm)
+
+# Status, stage timings and progress of a refresh/retrain job
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_runner.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={'detail': f'Job {job_id} not found'})
+    return job
+
+@app.get("/jobs")
+async def list_jobs(limit: int = 20):
+    return job_runner.list(limit)
+
+# Result cache counters, to size the cache
+@app.get("/cache_stats")
+async def cache_stats():
+    return result_cache.stats()
+
+# Connections checked out / overflowing and time waited for one, per worker
+@app.get("/db_pool_stats")
+async def db_pool_stats():
+    return pool_metrics.stats()
 
 # Get recommendations by userID - Content-Based Filtering
 @app.post("/recommend")
 async def recommend_product(customer: Customer, model: str = Query("collaborative", enum=['collaborative', 'content_based'])):
     model_map = {'collaborative': 'svd', 'content_based': 'knn'}
-    return TDS_GetRecs.main(model = model_map[model], user_id = customer.customer_id)
+    return await cached(('recommend', model_map[model], customer.customer_id), scoring_executor,
+                        lambda: TDS_GetRecs.main(model = model_map[model], user_id = customer.customer_id))
+
+# Product views of anonymous visitors, /recommend_cookie scores them on the next request.
+# Sessions live in the memory of the worker receiving the views, which should be the one
+# serving the cookie's recommendations (e.g. routing on the cookie).
+@app.post('/cookie_views')
+async def cookie_views(views: Annotated[list[CookieView], Field(max_length=COOKIE_VIEWS_MAX)]):
+    for view in views:
+        TDS_GetRecs.cookie_sessions.add(view.cookie, view.product_id, view.view_count)
+    return {'accepted': len(views)}
 
-# Get recommendations by Cookie
+# Live cookie sessions of this worker
+@app.get('/cookie_session_stats')
+async def cookie_session_stats():
+    return TDS_GetRecs.cookie_sessions.stats()
+
+# Recommendations of many customers as NDJSON, one {"customer_id", "recommended_items"} line each,
+# in request order. Results are not cached, bulk jobs would only evict the interactive ones.
+@app.post("/recommend_batch")
+async def recommend_product_batch(customers: CustomerBatch,
+                                  model: str = Query("collaborative", enum=['collaborative', 'content_based'])):
+    model_map = {'collaborative': 'svd', 'content_based': 'knn'}
+    def compute(block):
+        recommendations = TDS_GetRecs.main_batch(model_map[model], user_ids=block)
+        return [{'customer_id': customer_id, 'recommended_items': items}
+                for customer_id, items in zip(block, recommendations)]
+    return await ndjson_stream(customers.customer_ids, scoring_executor, compute)
+
+# Get recommendations by Cookie, cached until the cookie views another product
 @app.post('/recommend_cookie')
 async def recommend_product_cookie(cookie: Cookie):
-    return TDS_GetRecs.main(model='cookie_knn', user_id=cookie.cookie)
+    session_version = TDS_GetRecs.cookie_sessions.version(cookie.cookie)
+    return await cached(('recommend_cookie', 'cookie_knn', cookie.cookie, session_version), scoring_executor,
+                        lambda: TDS_GetRecs.main(model='cookie_knn', user_id=cookie.cookie))
 
 # Get similar items - Content-based Filtering
 @app.post("/get_similar_items")
 async def get_similar_items(product: Product):
-    recommended_items = TDS_GetRecs.main(model = 'knn', item_id = product.product_id)
-    return [int(i) for i in recommended_items]
+    def compute():
+        recommended_items = TDS_GetRecs.main(model = 'knn', item_id = product.product_id)
+        return [int(i) for i in recommended_items]
+    return await cached(('get_similar_items', 'knn', product.product_id), scoring_executor, compute)
+
+# Similar items of many products as NDJSON, one {"product_id", "similar_items"} line each,
+# similar_items is null for products the model does not know
+@app.post("/get_similar_items_batch")
+async def get_similar_items_batch(products: ProductBatch):
+    def compute(block):
+        similar = TDS_GetRecs.main_batch('knn', item_ids=block)
+        return [{'product_id': product_id, 'similar_items': None if items is None else [int(i) for i in items]}
+                for product_id, items in zip(block, similar)]
+    return await ndjson_stream(products.product_ids, scoring_executor, compute)
 
 # Get perfered product recommendations by category
 @app.post("/get_favorite_items")
 async def get_favorite_items(category: Category):
-    recommended_items = TDS_GetRecs.get_top_n_prefered_products(category=category.category_id)
+    recommended_items = await cached(('get_favorite_items', None, category.category_id), scoring_executor,
+                                     lambda: TDS_GetRecs.get_top_n_prefered_products(category=category.category_id))
     return recommended_items #{"recommended_items": recommended_items}
 
+def cross_sell_items(product_id, customer_id):
+    # Served from the co-purchase index, the SQL queries are only used until it is built
+    try:
+        return {'rec_items': TDS_GetRecs.get_cross_sell_items(product_id, customer_id)}
+    except FileNotFoundError:
+        pass
+
+    with get_cnxn() as cnxn:
+
+        if customer_id:
+            sql_query = queries.cross_sell_rec
+            rec_df = query_sql(sql_query, cnxn=cnxn, product_id=product_id, customer_id=customer_id)
+            recommended_items = rec_df['item_2'].tolist()
+            return {'rec_items': recommended_items}
+        else:
+            sql_query = queries.cross_sell_rec_all_customer
+            rec_df = query_sql(sql_query, cnxn=cnxn, product_id=product_id)
+            recommended_items = rec_df['item_2'].tolist()
+            return {'rec_items': recommended_items}
+
 # Get cross-sell recommendations by userID and productID
 @app.post("/cross_sell_rec")
 async def cross_sell_recommend(input: RSInput):
+    product_id = input.product_id
+    customer_id = input.customer_id
+    # May fall back to the database, so it runs on the DB pool threads
+    return await cached(('cross_sell_rec', customer_id, product_id), db_executor,
+                        lambda: cross_sell_items(product_id, customer_id))
 
-    with get_cnxn() as session:
-        with session.connection() as cnxn:
-
-            product_id = input.product_id
-            customer_id = input.customer_id
-
-            if customer_id:
-                sql_query = queries.cross_sell_rec
-                rec_df = query_sql(sql_query, cnxn=cnxn, ProductId=product_id, CustomerId=customer_id)
-                recommended_items = rec_df['item_2'].tolist()
-                return {'rec_items': recommended_items}
-            else:
-                sql_query = queries.cross_sell_rec_all_customer
-                rec_df = query_sql(sql_query, cnxn=cnxn, ProductId=product_id)
-                recommended_items = rec_df['item_2'].tolist()
-                return {'rec_items': recommended_items}
\ No newline at end of file
+# Cross-sell recommendations of many (product_id, customer_id) pairs as NDJSON,
+# one {"product_id", "customer_id", "rec_items"} line each
+@app.post("/cross_sell_rec_batch")
+async def cross_sell_recommend_batch(batch: RSInputBatch):
+    def compute(block):
+        return [{'product_id': input.product_id, 'customer_id': input.customer_id,
+                 **cross_sell_items(input.product_id, input.customer_id)} for input in block]
+    return await ndjson_stream(batch.inputs, db_executor, compute)
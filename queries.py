@@ -5,7 +5,7 @@ cross_sell_rec_all_customer = """select top 10 a.ProductId item_1,
     join OrdersItem b on a.OrdersId = b.OrdersId
     join Product pro on b.ProductId = pro.Id
     where a.ProductId <> b.ProductId
-        and a.ProductId = {ProductId}
+        and a.ProductId = :product_id
         and pro.Active = 1
     group by a.ProductId, b.ProductId
     order by times_bought_together desc"""
@@ -43,7 +43,7 @@ cross_sell_rec = """WITH
             FROM item_procat a
                 JOIN item_procat b ON a.OrdersId = b.OrdersId
             WHERE a.ProductId <> b.ProductId
-                AND a.CustomerId = {CustomerId} -- REPLACE BY CUSTOMER ID
+                AND a.CustomerId = :customer_id
         )
     ,
         pairCat_ranking
@@ -64,7 +64,7 @@ cross_sell_rec = """WITH
                 JOIN item_procat b ON a.OrdersId = b.OrdersId
                 JOIN Product pro ON b.ProductId = pro.Id
             WHERE a.ProductId <> b.ProductId
-                AND a.ProductId = {ProductId} -- REPLACE BY PRODUCT ID
+                AND a.ProductId = :product_id
                 AND pro.Active = 1
             GROUP BY a.ProductId, a.CategoryId, b.ProductId, b.CategoryId
         )
@@ -90,13 +90,14 @@ recsys_dataset_refresh = """WITH facebook_preference AS (
                 AND facebooklog.Intent IN ('GetFit','GetProductInfo','AddCart',
                 'HoldCart','ConfirmOrder','CheckoutCart','GetImage'), 3, 0)        
                 )) preference_score,
-            DATEDIFF(DAY, facebooklog.DateInserted, GETDATE()) recency
+            DATEDIFF(DAY, facebooklog.DateInserted, :anchor) recency
         FROM FacebookLogActivity facebooklog
             JOIN FacebookPostProduct facebookproduct ON facebooklog.PostId = facebookproduct.MainId
             JOIN Customer cus ON facebooklog.UserId = cus.Id
         WHERE facebooklog.Verb = 'add'
             AND facebooklog.UserId is not null
-            AND facebooklog.Item IN ('reaction','share','comment')),
+            AND facebooklog.Item IN ('reaction','share','comment')
+            AND {facebook_window}),
 
     order_preference AS (
         SELECT CustomerId, item.ProductId,
@@ -104,14 +105,24 @@ recsys_dataset_refresh = """WITH facebook_preference AS (
             IIF(IsAddCart = 1, 'addtocart', null)) action_type,
             (IIF(StatusId = 10, 7,
             IIF(IsAddCart = 1, 5, 0)) * Quantity) preference_score,
-            DATEDIFF(day,item.CreateTime,GETDATE()) recency
+            DATEDIFF(day,item.CreateTime,:anchor) recency
         FROM Orders ord
             JOIN OrdersItem item ON ord.Id = item.OrdersId
-        WHERE CustomerId is not null)
+        WHERE CustomerId is not null
+            AND {orders_window}),
 
-    SELECT CustomerId, ProductId, action_type, preference_score, recency FROM facebook_preference WHERE preference_score > 0
-    UNION
-    SELECT CustomerId, ProductId, action_type, preference_score, recency FROM order_preference WHERE preference_score > 0"""
+    preference AS (
+        SELECT CustomerId, ProductId, action_type, preference_score, recency FROM facebook_preference WHERE preference_score > 0
+        UNION
+        SELECT CustomerId, ProductId, action_type, preference_score, recency FROM order_preference WHERE preference_score > 0),
+
+    -- One event per customer, product, action and day
+    ranked_preference AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY CustomerId, ProductId, action_type, recency
+                                     ORDER BY preference_score DESC) rn
+        FROM preference)
+
+    SELECT CustomerId, ProductId, action_type, preference_score, recency FROM ranked_preference WHERE rn = 1"""
 
 recsys_product_preference = """WITH facebook_preference AS (
         SELECT facebookproduct.SubId ProductId,
@@ -122,19 +133,21 @@ recsys_product_preference = """WITH facebook_preference AS (
                 AND facebooklog.Intent IN ('GetFit','GetProductInfo','AddCart',
                 'HoldCart','ConfirmOrder','CheckoutCart','GetImage'), 3, 0)        
                 )) preference_score,
-            DATEDIFF(DAY, facebooklog.DateInserted, GETDATE()) recency
+            DATEDIFF(DAY, facebooklog.DateInserted, :anchor) recency
         FROM FacebookLogActivity facebooklog
             JOIN FacebookPostProduct facebookproduct ON facebooklog.PostId = facebookproduct.MainId
         WHERE facebooklog.Verb = 'add'
-            AND facebooklog.Item IN ('reaction','share','comment')),
+            AND facebooklog.Item IN ('reaction','share','comment')
+            AND {facebook_window}),
 
 order_preference AS (
     SELECT item.ProductId,
         (IIF(StatusId = 10, 7,
         IIF(IsAddCart = 1, 5, 0)) * Quantity) preference_score,
-        DATEDIFF(day,item.CreateTime,GETDATE()) recency
+        DATEDIFF(day,item.CreateTime,:anchor) recency
     FROM Orders ord
-        JOIN OrdersItem item ON ord.Id = item.OrdersId)
+        JOIN OrdersItem item ON ord.Id = item.OrdersId
+    WHERE {orders_window})
 
 , preference AS (SELECT ProductId, preference_score, recency FROM facebook_preference WHERE preference_score > 0
 UNION
@@ -184,3 +197,11 @@ join lastest_record c on a.CookieId = c.CookieId,
 (select max(recency) max_recency from a) as b
 where c.lastest_date >= DATEADD(MONTH, -6, GETDATE())
 group by a.CookieId, a.ProductId"""
+
+recsys_basket_dataset = """select item.OrdersId, ord.CustomerId, ord.StatusId, item.ProductId,
+        IIF(procat.ParentId IS NULL, procat.Id, procat.ParentId) CategoryId
+    from OrdersItem item
+        left join Orders ord on item.OrdersId = ord.Id
+        left join Product pro on item.ProductId = pro.Id
+        left join ProductCategory procat on pro.CategoryId = procat.Id
+    where item.ProductId is not null"""
\ No newline at end of file